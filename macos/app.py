@@ -22,16 +22,9 @@ class VideoboxApp(rumps.App):
 
     @rumps.events.on_wake
     def on_wake(self):
-        with self.flask_app.app_context():
-            # Wait for the current worker to finish 
-            #   for any pending operation
-            sync.sync_worker.abort()
-            sync.sync_worker.join(videobox.MAX_WORKER_TIMEOUT)
-            # Wait a bit to allow the device to connect to network
-            time.sleep(SYNC_DELAY)
-            # Restart with another worker
-            sync.sync_worker = sync.SyncWorker(self.flask_app.config["API_CLIENT_ID"])
-            sync.sync_worker.start()
+        # Wait a bit to allow the device to connect to network
+        time.sleep(SYNC_DELAY)
+        sync.sync_worker.wake()
 
     @rumps.events.before_quit
     def before_quit(self):
@@ -0,0 +1,106 @@
+"""
+Benchmark library import and update against a local stand-in API.
+
+    python -m tests.benchmark --series 50000 --episodes 40 --releases 2
+"""
+import os
+import sys
+import time
+import resource
+import tempfile
+from pathlib import Path
+import click
+from videobox import create_app
+import videobox.api as api
+import videobox.models as models
+import videobox.sync as sync
+from .fake_api import Catalog, FakeAPIServer
+
+CLIENT_ID = '123e4567-e89b-12d3-a456-426614174000'
+
+
+def get_peak_rss():
+    # Linux reports kilobytes, macOS bytes
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def get_database_size(data_dir):
+    return sum(path.stat().st_size for path in Path(data_dir).glob("library.db*"))
+
+
+def format_size(value):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if value < 1024:
+            break
+        value /= 1024
+    return f"{value:.1f}{unit}"
+
+
+def report(title, elapsed, stats):
+    click.echo(f"{title} completed in {elapsed:.1f}s")
+    click.echo(f"  {'Stage':<12} {'Requests':>9} {'Received':>10} {'Network':>9} {'Rows':>9} {'Database':>9} {'Rows/s':>9}")
+    for stage, values in stats.stages.items():
+        rows_per_second = values['rows_written'] / values['write_time'] if values['write_time'] else 0
+        click.echo(f"  {stage:<12} {values['request_count']:>9} {format_size(values['bytes_received']):>10} "
+                   f"{values['http_time']:>8.1f}s {values['rows_written']:>9} {values['write_time']:>8.1f}s {rows_per_second:>9.0f}")
+
+
+def run_benchmark(catalog, data_dir, update_fraction):
+    with FakeAPIServer(catalog) as server:
+        class BenchmarkConfig(object):
+            DATABASE_URL = f'sqlite:///{Path(data_dir).joinpath("library.db")}'
+            API_BASE_URL = server.url
+            API_CLIENT_ID = CLIENT_ID
+            API_CACHE_DIR = str(Path(data_dir).joinpath("cache"))
+            TESTING = True
+
+        app = create_app(data_dir=data_dir, config_class=BenchmarkConfig, start_workers=False)
+        with app.app_context():
+            models.setup()
+            worker = sync.SyncWorker(CLIENT_ID)
+
+            start_time = time.time()
+            worker.import_library()
+            report("Import", time.time() - start_time, worker.stats)
+            # Like a completed sync does
+            api.clear_response_cache(app.config['API_CACHE_DIR'])
+            last_log = models.SyncLog.create(status=models.SYNC_OK, description="Benchmark import")
+
+            catalog.update(update_fraction)
+            worker.stats = sync.SyncStats()
+            start_time = time.time()
+            worker.update_library(last_log)
+            report("Update", time.time() - start_time, worker.stats)
+            models.db_wrapper.database.close()
+
+    click.echo(f"Peak RSS {format_size(get_peak_rss())}, database size {format_size(get_database_size(data_dir))}")
+
+
+@click.command()
+@click.option("--series", default=5000, show_default=True, help="Number of series in the catalog.")
+@click.option("--episodes", default=40, show_default=True, help="Episodes for each series.")
+@click.option("--releases", default=2, show_default=True, help="Releases for each episode.")
+@click.option("--tags", default=40, show_default=True, help="Number of tags in the catalog.")
+@click.option("--update-fraction", default=0.01, show_default=True, help="Fraction of rows changed before the update.")
+@click.option("--data-dir", type=click.Path(file_okay=False), help="Keep library in this new or empty directory instead of a temporary one.")
+def benchmark(series, episodes, releases, tags, update_fraction, data_dir):
+    """
+    Import a synthetic catalog into a new library, then update it
+      and report throughput, peak RSS and database size.
+    """
+    catalog = Catalog(series_count=series, episodes_per_series=episodes, releases_per_episode=releases, tag_count=tags)
+    click.echo(f"Catalog has {catalog.series_count} series, {catalog.episode_count} episodes and {catalog.release_count} releases")
+    if data_dir:
+        # Never overwrite an existing library by mistake
+        if Path(data_dir).exists() and any(Path(data_dir).iterdir()):
+            raise click.BadParameter(f"Directory '{data_dir}' is not empty", param_hint="--data-dir")
+        os.makedirs(data_dir, exist_ok=True)
+        run_benchmark(catalog, data_dir, update_fraction)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            run_benchmark(catalog, data_dir, update_fraction)
+
+
+if __name__ == "__main__":
+    benchmark()
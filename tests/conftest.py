@@ -1,9 +1,15 @@
 from pathlib import Path
 import pytest
 from videobox import create_app
+from videobox.models import db_wrapper
+import videobox.models as models
+from .fake_api import Catalog
 
 TEST_DIR = Path(__file__).parent
 
+SIMPSONS = {'id': 1, 'tmdb_id': 1, 'name': 'The Simpsons', 'sort_name': 'Simpsons', 'original_name': '', 'slug': 'the-simpsons',
+            'overview': 'Springfield', 'network': 'FOX', 'status': 'R', 'language': 'en'}
+
 class TestingConfig(object):
     DATABASE_URL = 'sqlite:///:memory:'   
     API_CLIENT_ID = '123e4567-e89b-12d3-a456-426614174000'
@@ -11,4 +17,46 @@ class TestingConfig(object):
 
 @pytest.fixture()
 def app():
-    return create_app(config_class=TestingConfig)
\ No newline at end of file
+    return create_app(config_class=TestingConfig)
+
+@pytest.fixture()
+def file_config(tmp_path):
+    class FileConfig(TestingConfig):
+        # Library writer saves on its own connection
+        DATABASE_URL = f"sqlite:///{tmp_path.joinpath('library.db')}"
+
+    return FileConfig
+
+@pytest.fixture()
+def app_empty_db():
+    app = create_app(data_dir=TEST_DIR, config_class=TestingConfig)
+    models.setup()
+
+    yield app
+
+    db_wrapper.database.connection().close()
+
+def make_library(catalog):
+    """
+    Yield an app with catalog rows saved into the library the 
+      same way a first import does
+    """
+    app = create_app(config_class=TestingConfig)
+    with app.app_context():
+        models.setup()
+        # Leaves planner statistics behind
+        synchronous = models.begin_bulk_load()
+        models.save_tags(app, list(catalog.iter_rows("tags")))
+        models.save_series(app, list(catalog.iter_rows("series")))
+        models.save_series_tags(app, list(catalog.iter_rows("series-tags")))
+        models.save_episodes(app, list(catalog.iter_rows("episodes")))
+        models.save_releases(app, list(catalog.iter_rows("releases")))
+        models.end_bulk_load(synchronous)
+
+        yield app
+
+        db_wrapper.database.close()
+
+@pytest.fixture()
+def app_library():
+    yield from make_library(Catalog(series_count=10, episodes_per_series=5, releases_per_episode=2, tag_count=3))
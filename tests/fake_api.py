@@ -0,0 +1,273 @@
+"""
+Local stand-in for the Videobox API v4, serving a synthetic catalog.
+
+Rows are computed from their ids, so catalogs with millions of
+  episodes and releases are streamed without being held in memory.
+"""
+import json
+import zlib
+import hashlib
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from urllib.parse import urlsplit, parse_qs
+from videobox.api import API_VERSION
+
+STREAM_BATCH_SIZE = 1000
+EPISODES_PER_SEASON = 10
+LANGUAGES = ["en", "en", "en", "es", "fr", "de", "it", "ja", "ko"]
+NETWORKS = ["Netflix", "HBO", "BBC One", "Prime Video", "Apple TV+", "ABC"]
+RESOLUTIONS = [0, 480, 720, 1080, 1080, 2160]
+OVERVIEW = ("A synthetic overview, long about as much as a real one. "
+            "It is here only to give rows a realistic size when saved into the library. ")
+BASE_DATETIME = datetime(2024, 1, 1)
+
+
+class Catalog(object):
+    """
+    Synthetic library with a fixed shape, where each series has the same number
+      of episodes and each episode the same number of releases
+    """
+
+    def __init__(self, series_count=1000, episodes_per_series=40, releases_per_episode=2, tag_count=40, tags_per_series=3):
+        self.series_count = series_count
+        self.episodes_per_series = episodes_per_series
+        self.releases_per_episode = releases_per_episode
+        self.tag_count = tag_count
+        self.tags_per_series = tags_per_series
+        self.revision = 0
+        # Revision of each changed row, any other row is at revision zero
+        self.changes = {kind: {} for kind in ["tags", "series", "episodes", "releases"]}
+
+    @property
+    def episode_count(self):
+        return self.series_count * self.episodes_per_series
+
+    @property
+    def release_count(self):
+        return self.episode_count * self.releases_per_episode
+
+    def get_count(self, kind):
+        return {
+            "tags": self.tag_count,
+            "series": self.series_count,
+            "series-tags": self.series_count,
+            "episodes": self.episode_count,
+            "releases": self.release_count,
+        }[kind]
+
+    def update(self, fraction):
+        """
+        Change a fraction of series, episodes and releases,
+          as the server does between two syncs
+        """
+        self.revision += 1
+        for kind in ["series", "episodes", "releases"]:
+            count = self.get_count(kind)
+            step = max(1, int(1 / fraction)) if fraction else count + 1
+            # Shift changed rows on each revision
+            for id in range(1 + self.revision % step, count + 1, step):
+                self.changes[kind][id] = self.revision
+
+    def get_updated_ids(self, kind):
+        return sorted(id for id, revision in self.changes[kind].items() if revision == self.revision)
+
+    def get_row(self, kind, id):
+        revision = self.changes.get(kind, {}).get(id, 0)
+        return {
+            "tags": make_tag,
+            "series": make_series,
+            "episodes": make_episode,
+            "releases": make_release,
+        }[kind](self, id, revision)
+
+    def iter_rows(self, kind, ids=None):
+        if ids is None:
+            ids = range(1, self.get_count(kind) + 1)
+        for id in ids:
+            if not 0 < id <= self.get_count(kind):
+                continue
+            if kind == "series-tags":
+                yield from make_series_tags(self, id)
+            else:
+                yield self.get_row(kind, id)
+
+    def get_etag(self, kind):
+        return f'"{kind}-{self.get_count(kind)}-{self.revision}"'
+
+
+def make_tag(catalog, id, revision):
+    return {"id": id, "name": f"Tag {id}", "slug": f"tag-{id}", "type": "G"}
+
+
+def make_series(catalog, id, revision):
+    return {
+        "id": id,
+        "tmdb_id": id,
+        "imdb_id": f"tt{id:07d}",
+        "name": f"Series {id}",
+        "sort_name": f"Series {id}",
+        "original_name": f"Series {id}",
+        "slug": str(id),
+        "tagline": "",
+        "language": LANGUAGES[id % len(LANGUAGES)],
+        "overview": OVERVIEW,
+        "network": NETWORKS[id % len(NETWORKS)],
+        "vote_average": (id % 100) / 10,
+        "vote_count": id % 1000,
+        "popularity": (id * 7919 % 10000) / 100 + revision,
+        "status": "R" if id % 3 else "E",
+        "poster_url": f"http://image.example.com/poster/{id}.jpg",
+        "fanart_url": f"http://image.example.com/fanart/{id}.jpg",
+    }
+
+
+def make_series_tags(catalog, series_id):
+    tag_ids = {(series_id * (index + 1) * 31) % catalog.tag_count + 1 for index in range(catalog.tags_per_series)}
+    return [{"series_id": series_id, "tag_id": tag_id} for tag_id in sorted(tag_ids)]
+
+
+def make_episode(catalog, id, revision):
+    series_id, index = divmod(id - 1, catalog.episodes_per_series)
+    aired_on = BASE_DATETIME + timedelta(days=series_id % 365 + index * 7)
+    return {
+        "id": id,
+        "tmdb_id": id,
+        "name": f"Episode {index + 1}" + (f" (rev. {revision})" if revision else ""),
+        "season": index // EPISODES_PER_SEASON + 1,
+        "number": index % EPISODES_PER_SEASON + 1,
+        "type": "S",
+        "aired_on": aired_on.strftime("%Y-%m-%d"),
+        "overview": OVERVIEW,
+        "thumbnail_url": f"http://image.example.com/still/{id}.jpg",
+        "series_id": series_id + 1,
+    }
+
+
+def make_release(catalog, id, revision):
+    episode_id = (id - 1) // catalog.releases_per_episode + 1
+    info_hash = hashlib.sha1(str(id).encode()).hexdigest().upper()
+    added_on = BASE_DATETIME + timedelta(minutes=id)
+    name = f"Series S01E01 Release {id}"
+    return {
+        "id": id,
+        "magnet_uri": f"magnet:?xt=urn:btih:{info_hash}&dn={name.replace(' ', '%20')}&tr=udp%3A%2F%2Ftracker.example.com%3A6969%2Fannounce",
+        "info_hash": info_hash,
+        "size": id * 1024 % 4_000_000_000,
+        "seeders": id % 500 + revision,
+        "leechers": id % 50,
+        "completed": id % 5000,
+        "name": name,
+        "added_on": added_on.strftime("%Y-%m-%d %H:%M:%S"),
+        "last_updated_on": (added_on + timedelta(days=revision)).strftime("%Y-%m-%d %H:%M:%S"),
+        "resolution": RESOLUTIONS[id % len(RESOLUTIONS)],
+        "episode_id": episode_id,
+    }
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        pieces = url.path.strip("/").split("/")
+        catalog = self.server.catalog
+        self.server.request_count += 1
+        if len(pieces) < 2 or pieces[0] != str(API_VERSION) or pieces[1] not in ["tags", "series", "series-tags", "episodes", "releases"]:
+            self.send_error(404)
+            return
+        kind = pieces[1]
+        if pieces[2:] == ["updated"]:
+            self.send_json({
+                "alert": "",
+                "tags": catalog.get_updated_ids("tags"),
+                "series": catalog.get_updated_ids("series"),
+                "episodes": catalog.get_updated_ids("episodes"),
+                "releases": catalog.get_updated_ids("releases"),
+            })
+        elif pieces[2:] == ["all"]:
+            etag = catalog.get_etag(kind)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_rows(catalog.iter_rows(kind), etag)
+        elif not pieces[2:] and "ids" in query:
+            ids = [int(id) for id in query["ids"][0].split(",") if id]
+            self.send_json(list(catalog.iter_rows(kind, ids)))
+        else:
+            self.send_error(404)
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_rows(self, rows, etag):
+        # Stream as the real server does, without a known content length
+        compressor = zlib.compressobj(wbits=31) if "gzip" in self.headers.get("Accept-Encoding", "") else None
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        if compressor:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def write(data):
+            data = data.encode("utf-8")
+            self.wfile.write(compressor.compress(data) if compressor else data)
+
+        write("[")
+        batch, separator = [], ""
+        for row in rows:
+            batch.append(row)
+            if len(batch) == STREAM_BATCH_SIZE:
+                write(separator + json.dumps(batch)[1:-1])
+                batch, separator = [], ","
+        if batch:
+            write(separator + json.dumps(batch)[1:-1])
+        write("]")
+        if compressor:
+            self.wfile.write(compressor.flush())
+        self.close_connection = True
+
+
+class FakeAPIServer(ThreadingHTTPServer):
+    """
+    Serve a catalog on a local port from a background thread
+    """
+    daemon_threads = True
+
+    def __init__(self, catalog, host="127.0.0.1", port=0):
+        super().__init__((host, port), FakeAPIHandler)
+        self.catalog = catalog
+        self.request_count = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = Thread(target=self.serve_forever, name="Fake API server", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
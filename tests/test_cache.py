@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from videobox.models import Series, Tag
+import videobox.models as models
+import videobox.cache as cache
+import videobox.main.routes as routes
+
+def test_page_cache_eviction():
+    page_cache = cache.PageCache(max_size=10)
+    page_cache.get("a", lambda: "aaaa")
+    page_cache.get("b", lambda: "bbbb")
+    # Touch "a" so "b" is the least recently used
+    assert page_cache.get("a", lambda: "") == "aaaa"
+    page_cache.get("c", lambda: "cccc")
+    assert page_cache.size == 8
+    assert page_cache.get("a", lambda: "") == "aaaa"
+    assert page_cache.get("b", lambda: "") == ""
+    # Too large to be kept at all
+    assert page_cache.get("d", lambda: "d" * 20) == "d" * 20
+    assert page_cache.size <= 10
+
+def test_page_cache_bump():
+    page_cache = cache.PageCache()
+    page_cache.get("a", lambda: "old")
+    page_cache.bump()
+    assert page_cache.get("a", lambda: "new") == "new"
+
+    def render_during_sync():
+        page_cache.bump()
+        return "stale"
+
+    # Library changed while rendering, so fragment is not kept
+    assert page_cache.get("b", render_during_sync) == "stale"
+    assert page_cache.get("b", lambda: "fresh") == "fresh"
+
+def test_page_cache_memo():
+    page_cache = cache.PageCache(max_size=10)
+    assert page_cache.memo("stats", lambda: (1, 2)) == (1, 2)
+    assert page_cache.memo("stats", lambda: (3, 4)) == (1, 2)
+    # Values are kept apart from rendered fragments
+    assert page_cache.size == 0 and len(page_cache) == 0
+    page_cache.bump()
+    assert page_cache.memo("stats", lambda: (3, 4)) == (3, 4)
+
+def test_cached_tag_page(app_library):
+    client = app_library.test_client()
+    tag = Tag.select().first()
+    response = client.get(f"/tag/{tag.slug}")
+    assert response.status_code == 200
+    Series.update(name=Series.name.concat(" (renamed)")).execute()
+    # Served from cache until library changes
+    assert b"(renamed)" not in client.get(f"/tag/{tag.slug}").data
+    cache.page_cache.bump()
+    assert b"(renamed)" in client.get(f"/tag/{tag.slug}").data
+
+def test_conditional_get(app_library):
+    client = app_library.test_client()
+    models.SyncLog.create(status=models.SYNC_OK)
+    series = Series.select().first()
+    response = client.get(f"/series/{series.id}")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    # Following does not change sync date, so dates are never used to validate
+    assert not response.last_modified
+    assert client.get(f"/series/{series.id}", headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}).status_code == 200
+    response = client.get(f"/series/{series.id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert not response.data
+    # A different filter gives another page
+    client.set_cookie("filter-video-resolution", "720")
+    assert client.get(f"/series/{series.id}", headers={"If-None-Match": etag}).status_code == 200
+    client.delete_cookie("filter-video-resolution")
+    # Following changes the series row
+    Series.update(followed_since="2024-01-01").where(Series.id == series.id).execute()
+    assert client.get(f"/series/{series.id}", headers={"If-None-Match": etag}).status_code == 200
+
+def test_conditional_get_after_sync(app_library):
+    client = app_library.test_client()
+    tag = Tag.select().first()
+    etag = client.get(f"/tag/{tag.slug}").headers["ETag"]
+    assert client.get(f"/tag/{tag.slug}", headers={"If-None-Match": etag}).status_code == 304
+    cache.page_cache.bump()
+    assert client.get(f"/tag/{tag.slug}", headers={"If-None-Match": etag}).status_code == 200
+
+def test_cached_home_expires(app_library, monkeypatch):
+    client = app_library.test_client()
+    assert client.get("/").status_code == 200
+    keys = [key for _, key in cache.page_cache.fragments]
+    assert client.get("/").status_code == 200
+    assert [key for _, key in cache.page_cache.fragments] == keys
+
+    class LaterDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) + timedelta(hours=1)
+
+    # Today and this week lists are rendered again each hour
+    monkeypatch.setattr(routes, "datetime", LaterDatetime)
+    assert client.get("/").status_code == 200
+    assert len(cache.page_cache.fragments) == len(keys) + 1
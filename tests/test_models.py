@@ -0,0 +1,262 @@
+import json
+import threading
+import pytest
+import flask
+from peewee import IntegrityError, OperationalError
+from videobox import create_app
+from videobox.models import db_wrapper, Series, SeriesIndex, Tag
+import videobox.models as models
+from .conftest import TEST_DIR, SIMPSONS, TestingConfig
+
+@pytest.fixture()
+def app():
+    app = create_app(config_class=TestingConfig)
+
+    yield app
+
+    db_wrapper.database.close()
+
+def test_setup_new_library(app):
+    assert models.setup() == 0
+    assert db_wrapper.database.pragma('user_version') == models.SCHEMA_VERSION
+    assert Series.table_exists()
+    # Current schema is left alone
+    assert models.setup() == 0
+
+def test_setup_unversioned_library(app):
+    models.setup()
+    models.save_series(app, [SIMPSONS])
+    # Look like a library from version 0.8
+    db_wrapper.database.execute_sql('DROP VIEW series_search')
+    models.drop_search_index_triggers()
+    db_wrapper.database.execute_sql('ALTER TABLE series DROP COLUMN max_season')
+    models.BestRelease.drop_table()
+    db_wrapper.database.pragma('user_version', 0)
+    assert models.setup() == models.SCHEMA_VERSION
+    assert db_wrapper.database.pragma('user_version') == models.SCHEMA_VERSION
+    assert Series.get_by_id(1).max_season == 0
+    assert models.BestRelease.table_exists()
+    assert models.SeriesIndex.search("simpsons").exists()
+
+def test_failed_migration(app, monkeypatch):
+    models.setup()
+    db_wrapper.database.pragma('user_version', 0)
+
+    def migrate_failing():
+        db_wrapper.database.execute_sql('CREATE TABLE half_done (id INTEGER)')
+        raise ValueError("Migration failed")
+
+    monkeypatch.setattr(models, "MIGRATIONS", [migrate_failing])
+    with pytest.raises(ValueError):
+        models.setup()
+    # Step is rolled back and runs again on next start
+    assert db_wrapper.database.pragma('user_version') == 0
+    assert not db_wrapper.database.table_exists('half_done')
+
+def test_newer_schema(app):
+    models.setup()
+    db_wrapper.database.pragma('user_version', models.SCHEMA_VERSION + 1)
+    with pytest.raises(RuntimeError):
+        models.setup()
+
+@pytest.fixture()
+def app_writer(tmp_path, file_config, monkeypatch):
+    app = create_app(data_dir=tmp_path, config_class=file_config)
+    with app.app_context():
+        models.setup()
+        writer = models.DatabaseWriter(app)
+        monkeypatch.setattr(models, "db_writer", writer)
+        writer.start()
+
+        yield app
+
+        writer.abort()
+        writer.join()
+        db_wrapper.database.close()
+
+def test_database_writer(app_writer):
+    def save_tag(name):
+        return threading.current_thread().name, Tag.create(slug=name.lower(), name=name, type=models.TAG_GENRE).id
+
+    thread_name, tag_id = models.write(save_tag, "Drama")
+    assert thread_name == "Database writer"
+    assert Tag.get_by_id(tag_id).name == "Drama"
+    # Errors are raised on the calling thread and changes rolled back
+    with pytest.raises(IntegrityError):
+        models.write(lambda: (save_tag("Comedy"), Tag.create(id=tag_id, slug="x", name="x", type=models.TAG_GENRE)))
+    assert not Tag.select().where(Tag.name == "Comedy").exists()
+
+def test_query_only_connection(app_writer):
+    db_wrapper.set_query_only()
+    with pytest.raises(OperationalError):
+        Tag.create(slug="drama", name="Drama", type=models.TAG_GENRE)
+    models.write(Tag.create, slug="drama", name="Drama", type=models.TAG_GENRE)
+    assert Tag.select().count() == 1
+
+def test_stopped_database_writer(app_writer):
+    models.db_writer.abort()
+    models.db_writer.join()
+    with pytest.raises(RuntimeError):
+        models.db_writer.submit(Tag.select().count).result()
+
+def test_import_checkpoint(app_empty_db):
+    models.save_import_checkpoint(models.STAGE_EPISODES, 100, "10")
+    models.save_import_checkpoint(models.STAGE_EPISODES, 50, "20")
+    checkpoint = models.get_import_checkpoints()[models.STAGE_EPISODES]
+    assert (checkpoint.saved_count, checkpoint.last_key, checkpoint.completed) == (150, "20", False)
+    models.save_import_checkpoint(models.STAGE_EPISODES, completed=True)
+    checkpoint = models.get_import_checkpoints()[models.STAGE_EPISODES]
+    assert (checkpoint.saved_count, checkpoint.last_key, checkpoint.completed) == (150, "20", True)
+    assert models.get_import_started_on()
+    models.clear_import_checkpoints()
+    assert models.get_import_started_on() is None
+
+def test_upsert_counts(app_empty_db):
+    with open(TEST_DIR.joinpath("sync", 'tags.json'), "r") as json_file:
+        json_data = json.load(json_file)
+    count = models.save_tags(app_empty_db, json_data)
+    assert (count, count.inserted, count.updated) == (len(json_data), len(json_data), 0)
+    json_data[0]['name'] = "Renamed"
+    json_data.append({'id': 1000, 'name': "New", 'slug': "new", 'type': "G"})
+    count = models.save_tags(app_empty_db, json_data)
+    assert (count.inserted, count.updated) == (1, len(json_data) - 1)
+    assert Tag.get_by_id(json_data[0]['id']).name == "Renamed"
+    # Existing series tags are ignored
+    models.save_series(app_empty_db, [SIMPSONS])
+    series_tags = [{'series_id': 1, 'tag_id': 1000}]
+    assert models.save_series_tags(app_empty_db, series_tags).inserted == 1
+    assert models.save_series_tags(app_empty_db, series_tags) == 0
+
+def test_upsert_batch_size(app_empty_db, monkeypatch):
+    monkeypatch.setattr(models, "get_max_variables", lambda: 10)
+    trackers = [{'url': f"udp://tracker{index}.example.com:6969/announce"} for index in range(25)]
+    assert models.save_trackers(app_empty_db, trackers) == 25
+    assert models.Tracker.select().count() == 25
+
+def test_bulk_load(app_empty_db):
+    def get_index_names():
+        return {name for name, in db_wrapper.database.execute_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+    index_names = get_index_names()
+    synchronous = models.begin_bulk_load()
+    assert db_wrapper.database.pragma('synchronous') == 0
+    assert 'episode_series_id' not in get_index_names()
+    # Unique indexes are needed by upserts
+    assert 'release_info_hash' in get_index_names()
+    assert 'release_episode_id' in get_index_names()
+    with open(TEST_DIR.joinpath("sync", 'series.json'), "r") as json_file:
+        json_data = json.load(json_file)
+    models.save_series(app_empty_db, json_data)
+    # Search index is rebuilt at the end
+    assert not SeriesIndex.search("lie").exists()
+    models.end_bulk_load(synchronous)
+    assert get_index_names() == index_names
+    assert db_wrapper.database.pragma('synchronous') == synchronous
+    assert SeriesIndex.search("lie").exists()
+
+def test_series_index_triggers(app_empty_db):
+    with open(TEST_DIR.joinpath("sync", 'series.json'), "r") as json_file:
+        json_data = json.load(json_file)
+    models.save_series(app_empty_db, json_data)
+    series = Series.get(Series.name == "Would I Lie to You?")
+    Series.update(name="Zorblax", original_name="Zorblax").where(Series.id == series.id).execute()
+    assert not SeriesIndex.select().where(SeriesIndex.name.match("lie")).exists()
+    assert [found.rowid for found in SeriesIndex.search("zorblax")] == [series.id]
+    Series.delete().where(Series.id == series.id).execute()
+    assert not SeriesIndex.search("zorblax").exists()
+    SeriesIndex.integrity_check()
+
+def test_max_season(app_empty_db):
+    models.save_series(app_empty_db, [SIMPSONS])
+    assert models.Series.get_by_id(1).max_season == 0
+    episodes = [{'id': 10, 'tmdb_id': 10, 'series_id': 1, 'name': 'Pilot', 'season': 1, 'number': 1, 'overview': ''}]
+    models.save_episodes(app_empty_db, episodes)
+    assert models.Series.get_by_id(1).max_season == 1
+    episodes = [{'id': 11, 'tmdb_id': 11, 'series_id': 1, 'name': 'Premiere', 'season': 2, 'number': 1, 'overview': ''}]
+    models.save_episodes(app_empty_db, episodes)
+    # Saving series again leaves the value alone
+    models.save_series(app_empty_db, [dict(SIMPSONS, name='The Simpsons (US)')])
+    assert models.Series.get_by_id(1).max_season == 2
+    models.Series.update(max_season=0).execute()
+    assert models.update_max_seasons() == 1
+    assert models.Series.get_by_id(1).max_season == 2
+
+def test_best_releases(app_empty_db):
+    models.save_series(app_empty_db, [SIMPSONS])
+    models.save_episodes(app_empty_db, [{'id': 10, 'tmdb_id': 10, 'series_id': 1, 'name': 'Pilot', 'season': 1, 'number': 1, 'overview': ''}])
+    releases = [{'id': id, 'info_hash': f"{id:040d}", 'episode_id': 10, 'added_on': '2024-01-01 00:00:00', 'last_updated_on': '2024-01-01 00:00:00',
+                 'size': size, 'magnet_uri': '', 'seeders': seeders, 'leechers': 0, 'completed': 0, 'name': f"Release {id}", 'resolution': resolution}
+                for id, resolution, size, seeders in [(1, 720, 500, 10), (2, 1080, 900, 5), (3, 1080, 1200, 20), (4, 0, 100, 1)]]
+    models.save_releases(app_empty_db, releases)
+
+    def get_best_releases():
+        return {(best.resolution, best.ranking): best.release_id for best in models.BestRelease.select()}
+
+    assert get_best_releases() == {
+        (0, models.RANKING_SEEDERS): 3, (0, models.RANKING_SMALLEST): 4, (0, models.RANKING_LARGEST): 3,
+        (720, models.RANKING_SEEDERS): 1, (720, models.RANKING_SMALLEST): 1, (720, models.RANKING_LARGEST): 1,
+        (1080, models.RANKING_SEEDERS): 3, (1080, models.RANKING_SMALLEST): 2, (1080, models.RANKING_LARGEST): 3,
+    }
+    releases[1]['seeders'] = 50
+    models.save_releases(app_empty_db, releases[1:2])
+    best_releases = get_best_releases()
+    assert best_releases[(0, models.RANKING_SEEDERS)] == 2
+    assert best_releases[(1080, models.RANKING_SEEDERS)] == 2
+    models.refresh_best_releases()
+    assert get_best_releases() == best_releases
+    with app_empty_db.test_client() as client:
+        response = client.get("/series/1?resolution=1080&size=asc")
+        assert response.status_code == 200
+        assert b"Release 2" in response.data
+        assert b"Release 3" not in response.data
+
+def test_save_unchanged_series(app_empty_db):
+    with open(TEST_DIR.joinpath("sync", 'series.json'), "r") as json_file:
+        json_data = json.load(json_file)
+    assert models.save_series(app_empty_db, json_data) == len(json_data)
+    # Nothing changed on the server
+    assert models.save_series(app_empty_db, json_data) == 0
+    json_data[0]['popularity'] += 1
+    assert models.save_series(app_empty_db, json_data) == 1
+    assert Series.get_by_id(json_data[0]['id']).popularity == json_data[0]['popularity']
+
+def make_pool_app(tmp_path, **config):
+    app = flask.Flask(__name__)
+    app.config.update(DATABASE_URL=f"sqlite:///{tmp_path.joinpath('library.db')}", TESTING=False, **config)
+    wrapper = models.AppDB()
+    wrapper.init_app(app)
+
+    @app.route("/")
+    def index():
+        return str(id(wrapper.database.connection()))
+
+    return app, wrapper
+
+def test_connection_pragmas(tmp_path):
+    app, wrapper = make_pool_app(tmp_path, DATABASE_CACHE_SIZE=1234, DATABASE_MMAP_SIZE=1024*1024)
+    # Nothing is opened while creating the app
+    assert wrapper.database.is_closed()
+    wrapper.database.connect()
+    assert wrapper.database.pragma('cache_size') == -1234
+    assert wrapper.database.pragma('mmap_size') == 1024*1024
+    wrapper.database.close()
+
+def test_thread_connection_reused(tmp_path):
+    app, wrapper = make_pool_app(tmp_path)
+    client = app.test_client()
+    connection_id = client.get("/").data
+    assert not wrapper.database.is_closed()
+    assert client.get("/").data == connection_id
+    # Other threads get their own connection
+    other_ids = []
+    thread = threading.Thread(target=lambda: other_ids.append(app.test_client().get("/").data))
+    thread.start()
+    thread.join()
+    assert other_ids[0] != connection_id
+    wrapper.database.close()
+
+def test_connection_per_request(tmp_path):
+    app, wrapper = make_pool_app(tmp_path, DATABASE_POOL=False)
+    client = app.test_client()
+    client.get("/")
+    assert wrapper.database.is_closed()
@@ -0,0 +1,106 @@
+import re
+import pytest
+from videobox.models import db_wrapper, Series, Tag
+import videobox.models as models
+import videobox.main.queries as queries
+import videobox.scraper as scraper
+from .conftest import SIMPSONS, make_library
+from .fake_api import Catalog
+
+# Tables which grow with the library and must never be fully scanned
+LARGE_TABLES = ["episode", "release"]
+
+# Library stats and chart aggregate the whole library on purpose
+PLANNED_QUERIES = {
+    "series_tags": lambda: queries.get_series_tags(Series.get_by_id(1)),
+    "top_tags": lambda: queries.get_top_tags(10),
+    "featured_series": lambda: queries.get_featured_series([1], 2),
+    "today_series": lambda: queries.get_today_series(10),
+    "followed_series": lambda: queries.get_followed_series(),
+    "followed_series_days": lambda: queries.get_followed_series(7),
+    "top_series_for_tags": lambda: queries.get_top_series_for_tags(),
+    "series_for_tag": lambda: queries.get_series_for_tag(Tag.get_by_id(1), "popularity"),
+    "series_for_tag_after": lambda: queries.get_series_for_tag(Tag.get_by_id(1), "asc", after_id=10),
+    "series_for_language": lambda: queries.get_series_for_language("en"),
+    "series_for_language_after": lambda: queries.get_series_for_language("en", after_id=10),
+    "series_with_ids": lambda: queries.get_series_with_ids([1, 2]),
+    "series_torrents": lambda: queries.get_series_torrents(Series.get_by_id(1)),
+    "search_series": lambda: queries.search_series("series"),
+    "suggest_series": lambda: queries.suggest_series("series"),
+    "search_episodes": lambda: queries.search_episodes("episode"),
+    "suggest_episodes": lambda: queries.suggest_episodes("episode"),
+    "scraper_releases": lambda: scraper.get_releases(100),
+}
+
+
+@pytest.fixture(scope="module")
+def app_large_library():
+    for app in make_library(Catalog(series_count=200, episodes_per_series=20, releases_per_episode=2)):
+        Series.update(followed_since="2024-01-01").where(Series.id <= 2).execute()
+        yield app
+
+
+def get_full_scans(query):
+    """
+    Return the large tables which query plan reads from start to end
+    """
+    sql, params = query.sql()
+    # Peewee refers to tables with aliases
+    tables = dict((alias, table) for table, alias in re.findall(r'"(\w+)" AS "(\w+)"', sql))
+    scans = []
+    for row in db_wrapper.database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params):
+        match = re.match(r"SCAN (\w+)", row[-1])
+        # A covering index scan still reads every row
+        if match and tables.get(match.group(1), match.group(1)) in LARGE_TABLES:
+            scans.append(row[-1])
+    return scans
+
+
+@pytest.mark.parametrize("name", PLANNED_QUERIES)
+def test_query_plan(app_large_library, name):
+    assert get_full_scans(PLANNED_QUERIES[name]()) == []
+
+
+@pytest.mark.parametrize("sorting", ["popularity", "asc", "desc"])
+def test_keyset_pagination(app_large_library, sorting):
+    tag = Tag.get_by_id(1)
+    # Make sure ties are broken the same way on every page
+    Series.update(popularity=1).where(Series.id % 3 == 0).execute()
+    expected = [s.id for s in queries.get_series_for_tag(tag, sorting)]
+    found, after_id = [], None
+    while True:
+        page = [s.id for s in queries.get_series_for_tag(tag, sorting, after_id).limit(7)]
+        if not page:
+            break
+        found.extend(page)
+        after_id = page[-1]
+    assert len(expected) > 7
+    assert found == expected
+
+
+def test_full_scan_detected(app_large_library):
+    # Make sure the harness notices a scan
+    query = models.Release.select().where(models.Release.last_updated_on > "2024-01-01")
+    assert get_full_scans(query)
+
+
+def test_episode_index(app_empty_db):
+    episodes = [{'id': 10, 'tmdb_id': 10, 'series_id': 1, 'name': 'Treehouse of Horror', 'season': 2, 'number': 3, 'overview': 'Halloween stories'},
+                {'id': 11, 'tmdb_id': 11, 'series_id': 1, 'name': 'Bart the Genius', 'season': 1, 'number': 2, 'overview': 'Bart swaps a test'},
+                {'id': 12, 'tmdb_id': 12, 'series_id': 1, 'name': 'Simpsons Roasting', 'season': 0, 'number': 1, 'overview': 'Christmas with Bart'}]
+    models.save_series(app_empty_db, [SIMPSONS])
+    models.save_episodes(app_empty_db, episodes)
+    assert [episode.id for episode in queries.search_episodes("halloween")] == [10]
+    # Older seasons are not shown in series detail
+    assert not queries.search_episodes("christmas").exists()
+    assert not queries.suggest_episodes("roasting").exists()
+    # Name matches rank first
+    assert [episode.id for episode in queries.search_episodes("bart")] == [11]
+    episodes[0]['name'] = "Treehouse of Terror"
+    models.save_episodes(app_empty_db, episodes)
+    assert [episode.id for episode in queries.suggest_episodes("terr")] == [10]
+    assert not queries.suggest_episodes("horror").exists()
+    with app_empty_db.test_client() as client:
+        response = client.get("/search?query=terror")
+        assert response.status_code == 302
+        assert response.location.endswith("/series/1#e10")
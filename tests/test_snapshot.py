@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+from pathlib import Path
+import pytest
+from videobox import create_app
+import videobox.snapshot as snapshot
+import videobox.models as models
+from videobox.models import db_wrapper, Episode, Release, SeriesIndex, SyncLog
+from .conftest import SIMPSONS, TestingConfig
+
+TEST_DIR = Path(__file__).parent
+
+SERIES = [SIMPSONS]
+EPISODES = [{'id': 10, 'tmdb_id': 10, 'series_id': 1, 'name': 'Pilot', 'season': 1, 'number': 1}]
+RELEASES = [{'id': 100, 'info_hash': 'a' * 40, 'episode_id': 10, 'added_on': '2024-01-01 10:00:00', 'last_updated_on': '2024-01-01 10:00:00', 'size': 1000, 'magnet_uri': 'magnet:?xt=urn:btih:' + 'a' * 40, 'seeders': 1, 'leechers': 1, 'completed': 1, 'name': 'The.Simpsons.S01E01.720p', 'resolution': 720}]
+
+@pytest.fixture()
+def app():
+    app = create_app(data_dir=TEST_DIR, config_class=TestingConfig)
+    models.setup()
+
+    yield app
+
+    db_wrapper.database.connection().close()
+
+def test_export_import_snapshot(app, tmp_path):
+    models.save_series(app, SERIES)
+    models.save_episodes(app, EPISODES)
+    models.save_releases(app, RELEASES)
+    synced_on = datetime(2024, 1, 2, 12, 0, tzinfo=timezone.utc)
+    SyncLog.create(timestamp=synced_on, status=models.SYNC_OK)
+    path = tmp_path.joinpath("library.db.gz")
+    assert snapshot.export_snapshot(path) == 1
+
+    # Start over with an empty in-memory library
+    db_wrapper.database.close()
+    models.setup()
+    assert snapshot.import_snapshot(path) == 1
+    assert Episode.select().count() == 1
+    assert Release.get_by_id(100).info_hash == 'a' * 40
+    assert [series.rowid for series in SeriesIndex.search("simpsons")] == [1]
+    assert models.get_last_successful_log().timestamp == synced_on.replace(tzinfo=None)
+
+    # Never overwrite an existing library
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.import_snapshot(path)
+
+def test_import_invalid_snapshot(app, tmp_path):
+    path = tmp_path.joinpath("library.db.gz")
+    path.write_bytes(b"Not a snapshot")
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.import_snapshot(path)
@@ -1,13 +1,18 @@
 from datetime import datetime, timezone
 from pathlib import Path
 from peewee import fn
+import io
+import time
 import json
 import pytest
+import requests
 from videobox import create_app
 import videobox.sync as sync
+import videobox.api as api
 from videobox.models import db_wrapper, Tag, Series, SeriesTag, Episode, Release
 import videobox.models as models
 from .conftest import TestingConfig
+from .fake_api import Catalog, FakeAPIServer
 
 TEST_DIR = Path(__file__).parent
 
@@ -52,3 +57,246 @@ def test_save_releases(app):
         json_data = json.load(json_file)
         assert models.save_releases(app, json_data) == len(json_data)
         assert Release.get_or_none(id=json_data[0]['id'])
+
+def test_iter_json_batches(monkeypatch):
+    with open(TEST_DIR.joinpath("sync", 'releases.json'), "rb") as json_file:
+        data = json_file.read()
+    response = requests.Response()
+    response.raw = io.BytesIO(data)
+    response.headers['Content-Length'] = str(len(data))
+    response.encoding = 'utf-8'
+    # Force tiny reads to exercise items split across chunks
+    monkeypatch.setattr(api, "READ_CHUNK_SIZE", 7)
+    batches = list(api.iter_json_batches(response, 3))
+    assert [item for batch, _ in batches for item in batch] == json.loads(data)
+    assert all(len(batch) <= 3 for batch, _ in batches)
+    assert batches[-1][1] == 100
+
+class FakeResponse(object):
+
+    def __init__(self, json_data, status_code=200, headers=None):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(response=self)
+
+    def close(self):
+        pass
+
+    def json(self):
+        return self.json_data
+
+@pytest.fixture()
+def worker():
+    app = create_app(data_dir=TEST_DIR, config_class=TestingConfig)
+    with app.app_context():
+        yield sync.SyncWorker(app.config['API_CLIENT_ID'])
+
+def test_chunked_request_order(worker):
+    def handler(session, client_id, ids):
+        # Make later chunks complete first
+        time.sleep(0.001 * (10 - ids[0] // api.INITIAL_CHUNK_SIZE))
+        return FakeResponse([{'id': id} for id in ids])
+
+    ids = list(range(api.INITIAL_CHUNK_SIZE * 10 + 7))
+    result = worker.do_chunked_request(handler, None, ids, "test")
+    assert [item['id'] for json in result for item in json] == ids
+
+def test_id_chunks_fit_url(worker):
+    ids = list(range(10**6, 10**6 + 5000))
+    max_length = api.get_ids_max_length(worker.client_id)
+    sizer = api.ChunkSizer(size=api.MAX_CHUNK_SIZE)
+    chunks = [chunk for _, chunk in api.iter_id_chunks(ids, sizer, max_length)]
+    assert [id for chunk in chunks for id in chunk] == ids
+    assert all(len(api.make_ids(chunk)) <= max_length for chunk in chunks)
+
+def test_chunk_sizer():
+    sizer = api.ChunkSizer(size=100)
+    sizer.on_response(0.1)
+    assert sizer.size > 100
+    sizer.on_timeout()
+    assert sizer.size < 100
+    for _ in range(20):
+        sizer.on_timeout()
+    assert sizer.size == api.MIN_CHUNK_SIZE
+
+def test_sync_scheduler():
+    scheduler = sync.SyncScheduler(interval=3600)
+    # Busy period, sync more often
+    scheduler.on_sync(sync.TARGET_SYNC_UPDATES * 4, 3600)
+    assert scheduler.interval < 3600
+    for _ in range(10):
+        scheduler.on_sync(sync.TARGET_SYNC_UPDATES * 100, scheduler.interval)
+    assert scheduler.interval == sync.MIN_SYNC_INTERVAL
+    # Quiet period, back off
+    for _ in range(10):
+        scheduler.on_sync(0, scheduler.interval)
+    assert scheduler.interval == sync.MAX_SYNC_INTERVAL
+
+def test_wake_worker(worker):
+    with worker.app.test_client() as client:
+        # Worker is not running while testing
+        assert client.post("/sync").status_code == 503
+    worker.wake()
+    assert worker.wake_event.is_set()
+    worker.abort()
+    assert worker.abort_event.is_set()
+
+def test_library_writer(worker):
+    saved = []
+
+    def save_handler(app, batch):
+        time.sleep(0.001)
+        saved.extend(batch)
+        return len(batch)
+
+    writer = sync.LibraryWriter(worker.app, max_pending=2)
+    writer.start()
+    for index in range(10):
+        writer.save("test", save_handler, list(range(index*5, index*5 + 5)))
+    writer.close()
+    assert saved == list(range(50))
+    assert writer.get_count(save_handler) == 50
+    assert writer.stats.stages["test"]["rows_written"] == 50
+
+def test_library_writer_error(worker):
+    def save_handler(app, batch):
+        raise ValueError("Boom")
+
+    writer = sync.LibraryWriter(worker.app)
+    writer.start()
+    writer.save("test", save_handler, [1])
+    with pytest.raises(sync.SyncError):
+        writer.close()
+
+def test_library_writer_bulk_error(worker, monkeypatch):
+    def begin_bulk_load():
+        raise RuntimeError("Boom")
+
+    monkeypatch.setattr(models, "begin_bulk_load", begin_bulk_load)
+    writer = sync.LibraryWriter(worker.app, max_pending=2, bulk=True)
+    writer.start()
+    # Producers get the error instead of blocking on a full queue
+    with pytest.raises(sync.SyncError):
+        for index in range(10):
+            writer.save("test", lambda app, batch: len(batch), [index])
+    with pytest.raises(sync.SyncError):
+        writer.close()
+
+def test_streaming_import_progress(tmp_path, file_config, monkeypatch):
+    monkeypatch.setattr(sync, "IMPORT_BATCH_SIZE", 1)
+    messages = []
+    # Streamed without Content-Length, as the real server does
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(TEST_DIR.joinpath("sync", "tags.json").read_bytes())
+    response.encoding = 'utf-8'
+    app = create_app(data_dir=tmp_path, config_class=file_config)
+    with app.app_context():
+        models.setup()
+        worker = sync.SyncWorker(app.config['API_CLIENT_ID'], progress_callback=messages.append)
+        worker.stats = sync.SyncStats()
+        writer = sync.LibraryWriter(app)
+        writer.start()
+        count = worker.do_streaming_import(lambda: response, writer, models.save_tags, models.STAGE_TAGS, None, "Saving tags")
+        writer.close()
+        db_wrapper.database.close()
+    assert count == 2
+    assert messages == ["Saving tags 1 rows", "Saving tags 2 rows"]
+
+def test_sync_stats(app_empty_db):
+    stats = sync.SyncStats()
+    stats.add_request(models.STAGE_SERIES, 1000, 0.5)
+    stats.add_request(models.STAGE_SERIES, 500, 0.25)
+    stats.add_write(models.STAGE_SERIES, 200, 0.1)
+    log = models.SyncLog.create(timestamp=datetime.now(timezone.utc), status=models.SYNC_OK)
+    models.save_sync_stats(log, stats.stages)
+    [log] = models.get_sync_logs(1)
+    [stat] = log.stats
+    assert (stat.stage, stat.request_count, stat.bytes_received, stat.rows_written) == (models.STAGE_SERIES, 2, 1500, 200)
+    assert stat.rows_per_second == pytest.approx(2000)
+    with app_empty_db.test_client() as client:
+        response = client.get("/sync/log")
+        assert response.status_code == 200
+        assert b"Series" in response.data
+
+def test_response_cache(worker, tmp_path):
+    path = f"{api.API_VERSION}/series/all?client={worker.client_id}"
+    assert api.get_cache_key(path) == "4-series-all"
+    cache_entry = api.ResponseCache(tmp_path, path)
+    assert cache_entry.get_conditional_headers() == {}
+    data = b'[{"id": 1}, {"id": 2}]'
+    cache_entry.body_path.write_bytes(data)
+    cache_entry.save(cache_entry.body_path, {'etag': '"abc"'})
+    assert cache_entry.get_conditional_headers() == {'If-None-Match': '"abc"'}
+    # Server says data is still the same
+    not_modified = requests.Response()
+    not_modified.status_code = 304
+    not_modified.raw = io.BytesIO(b"")
+    response = cache_entry.handle_response(not_modified)
+    assert response.status_code == 200
+    assert [item for batch, _ in api.iter_json_batches(response, 10) for item in batch] == [{"id": 1}, {"id": 2}]
+    response.close()
+
+def test_response_cache_keeps_stage_in_progress(worker, tmp_path):
+    entries = {}
+    for name in ["tags", "series"]:
+        entries[name] = api.ResponseCache(tmp_path, f"{api.API_VERSION}/{name}/all")
+        entries[name].body_path.write_bytes(b"[]")
+        entries[name].save(entries[name].body_path, {'etag': f'"{name}"'})
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(b"[]")
+    entries["series"].handle_response(response)
+    # Previous stage was completed, only the current one is kept
+    assert not entries["tags"].body_path.exists() and not entries["tags"].meta_path.exists()
+    assert entries["series"].body_path.exists()
+    api.clear_response_cache(tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+def test_retry_transient_errors(worker, monkeypatch):
+    monkeypatch.setattr(sync, "RETRY_BACKOFF_BASE", 0.001)
+    responses = [FakeResponse(None, 503), FakeResponse(None, 429, {'Retry-After': '0'}), FakeResponse([1])]
+    assert worker.do_json_request(lambda: responses.pop(0)) == [1]
+    assert worker.retry_policy.budget == sync.MAX_RETRIES_PER_SYNC - 2
+
+def test_retry_fatal_errors(worker):
+    with pytest.raises(sync.SyncError):
+        worker.do_json_request(lambda: FakeResponse(None, 404))
+    # Server asks to come back later than we are willing to wait
+    with pytest.raises(sync.SyncError):
+        worker.do_json_request(lambda: FakeResponse(None, 503, {'Retry-After': str(sync.MAX_RETRY_AFTER + 1)}))
+
+def test_retry_budget(worker, monkeypatch):
+    monkeypatch.setattr(sync, "RETRY_BACKOFF_BASE", 0.001)
+    worker.retry_policy = sync.RetryPolicy(budget=1)
+    with pytest.raises(sync.SyncError):
+        worker.do_json_request(lambda: FakeResponse(None, 502))
+    assert worker.retry_policy.budget == 0
+
+def test_sync_with_fake_api(tmp_path, file_config):
+    catalog = Catalog(series_count=20, episodes_per_series=5, releases_per_episode=2, tag_count=5)
+    with FakeAPIServer(catalog) as server:
+        class FakeAPIConfig(file_config):
+            API_BASE_URL = server.url
+            API_CACHE_DIR = str(tmp_path.joinpath('cache'))
+
+        app = create_app(data_dir=tmp_path, config_class=FakeAPIConfig)
+        with app.app_context():
+            models.setup()
+            worker = sync.SyncWorker(app.config['API_CLIENT_ID'])
+            assert worker.import_library() == (5, 20, 100, 200)
+            # Only the response of the last stage is still cached
+            assert [path.name for path in tmp_path.joinpath('cache').glob('*.json')] == ['4-releases-all.json']
+            last_log = models.SyncLog.create(status=models.SYNC_OK)
+            catalog.update(0.1)
+            _, _, series_count, episode_count, release_count = worker.update_library(last_log)
+            assert (series_count, episode_count, release_count) == (2, 10, 20)
+            db_wrapper.database.close()
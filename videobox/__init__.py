@@ -16,11 +16,13 @@ import sqlite3
 import waitress
 import uuid
 import videobox.models as models
+import videobox.cache as cache
 import videobox.filters as filters
 from .main import bp as main_blueprint
 from videobox.main.announcer import announcer
 import videobox.sync as sync
 import videobox.scraper as scraper
+import videobox.snapshot as snapshot
 import tomli_w
 try:
     import tomllib as toml  # Python 3.11+
@@ -35,7 +37,7 @@ CONFIG_FILENAME = 'config.toml'
 DEFAULT_DATA_DIR = Path.home().joinpath(".videobox")
 MAX_WORKER_TIMEOUT = 10 # Seconds
 
-def create_app(app_dir=None, data_dir=None, config_class=None):
+def create_app(app_dir=None, data_dir=None, config_class=None, start_workers=True):
     if app_dir:
         app = flask.Flask(__name__, template_folder=os.path.join(app_dir, "templates"), static_folder=os.path.join(app_dir, "static"))
     else:
@@ -71,6 +73,8 @@ def create_app(app_dir=None, data_dir=None, config_class=None):
             with open(config_path, "wb") as f:
                 tomli_w.dump(config, f)
 
+    app.config.setdefault('API_CACHE_DIR', str(data_dir.joinpath("cache")))
+
     # Initialize Flask extensions here
 
     models.db_wrapper.init_app(app)
@@ -81,13 +85,16 @@ def create_app(app_dir=None, data_dir=None, config_class=None):
 
     # Make sure db schema is updated but not while testing
     if not app.config['TESTING']:
-        migrate_count = models.setup()
-        if migrate_count:
-            app.logger.debug(f"Changed {migrate_count} database schema fields")
+        migration_count = models.setup()
+        if migration_count:
+            app.logger.debug(f"Applied {migration_count} database schema migrations")
 
     app.logger.debug(f"Using SQLite {sqlite3.sqlite_version} with database {app.config['DATABASE_URL']}")
     app.logger.debug(f"Client ID is {app.config['API_CLIENT_ID']}")
 
+    # Rendered pages are kept until next library change
+    cache.page_cache = cache.PageCache(app.config.get('PAGE_CACHE_SIZE', cache.DEFAULT_CACHE_SIZE))
+
     # Register main app routes
     app.register_blueprint(main_blueprint)
 
@@ -118,7 +125,10 @@ def create_app(app_dir=None, data_dir=None, config_class=None):
         sync.sync_worker = sync.SyncWorker(app.config["API_CLIENT_ID"], done_callback=on_update_done)
 
         # Do not start workers while testing
-        if not app.config['TESTING']:
+        if not app.config['TESTING'] and start_workers:
+            # Workers and requests change the library through this thread
+            models.db_writer = models.DatabaseWriter(app)
+            models.db_writer.start()
             sync.sync_worker.start()     
             if app.config.get('TORRENT_ENABLED', False):
                 download_dir = app.config.get('TORRENT_DOWNLOAD_DIR', '')
@@ -144,8 +154,8 @@ def create_app(app_dir=None, data_dir=None, config_class=None):
     return app
 
 def shutdown_workers(app):
-    # Shutdown all worker threads
-    for worker in [sync.sync_worker, bt.torrent_worker]:        
+    # Shutdown all worker threads, database writer last so it saves their changes
+    for worker in [sync.sync_worker, bt.torrent_worker, models.db_writer]:        
         if worker:
             worker.abort()
             if worker.is_alive():
@@ -167,9 +177,46 @@ def save_config(data_dir, app):
     with open(config_path, "wb") as f:
         tomli_w.dump(config, f)    
 
-@click.command()
-@click.option('--host', help='Hostname or IP address on which to listen, default is 0.0.0.0, which means "all IP addresses on this host".', default="0.0.0.0")
-@click.option('--port', help='TCP port on which to listen, default is 8080', type=int, default=8080)
+host_option = click.option('--host', help='Hostname or IP address on which to listen, default is 0.0.0.0, which means "all IP addresses on this host".', default="0.0.0.0")
+port_option = click.option('--port', help='TCP port on which to listen, default is 8080', type=int, default=8080)
+
+@click.group(invoke_without_command=True)
+@host_option
+@port_option
+@click.pass_context
+def cli(ctx, host, port):
+    # Start the web interface if no other command is given
+    if ctx.invoked_subcommand is None:
+        ctx.invoke(serve, host=host, port=port)
+
+@cli.command()
+@host_option
+@port_option
 def serve(host, port):
+    """Start the web interface and the library sync."""
     print(f'Videobox has started. Point your browser to http://{"localhost" if host == "0.0.0.0" else host}:{port} to use the web interface.')
     waitress.serve(create_app(), host=host, port=port, threads=8)
+
+@cli.command('export-snapshot')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def export_snapshot(path):
+    """Save a compressed copy of the library to PATH."""
+    app = create_app(start_workers=False)
+    with app.app_context():
+        try:
+            series_count = snapshot.export_snapshot(path)
+        except snapshot.SnapshotError as ex:
+            raise click.ClickException(str(ex))
+    print(f"Exported {series_count} series to {path}.")
+
+@cli.command('import-snapshot')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_snapshot(path):
+    """Load a library snapshot from PATH into an empty library."""
+    app = create_app(start_workers=False)
+    with app.app_context():
+        try:
+            series_count = snapshot.import_snapshot(path)
+        except snapshot.SnapshotError as ex:
+            raise click.ClickException(str(ex))
+    print(f"Imported {series_count} series from {path}, next sync will only request newer updates.")
@@ -1,33 +1,47 @@
+import codecs
+import json
+import os
+import re
+from pathlib import Path
+from threading import Lock
 from flask import current_app
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit, parse_qsl, urlencode
+import requests
 import videobox
 
 TIMEOUT = 10
 API_VERSION = 4
 DEFAULT_API_BASE_URL = "https://www.videobox.passiomatic.com/"
 USER_AGENT = f"Videobox/{videobox.__version__} (https://pypi.org/project/videobox/)"
+READ_CHUNK_SIZE = 64*1024    # Bytes
+MAX_URL_LENGTH = 4096        # Bytes, total URI must be < 4096
+INITIAL_CHUNK_SIZE = 450     # Ids per request
+MIN_CHUNK_SIZE = 25          
+MAX_CHUNK_SIZE = 2000        
+FAST_RESPONSE_TIME = 2       # Seconds
+SLOW_RESPONSE_TIME = 6       # Seconds
 
 # Full import
 
 
 def get_all_tags(session, client_id):
-    return get_url(session, f"{API_VERSION}/tags/all?client={client_id}")
+    return get_url(session, f"{API_VERSION}/tags/all?client={client_id}", stream=True, cache=True)
 
 
 def get_all_series(session, client_id):
-    return get_url(session, f"{API_VERSION}/series/all?client={client_id}")
+    return get_url(session, f"{API_VERSION}/series/all?client={client_id}", stream=True, cache=True)
 
 
 def get_all_series_tags(session, client_id):
-    return get_url(session, f"{API_VERSION}/series-tags/all?client={client_id}")
+    return get_url(session, f"{API_VERSION}/series-tags/all?client={client_id}", stream=True, cache=True)
 
 
 def get_all_episodes(session, client_id):
-    return get_url(session, f"{API_VERSION}/episodes/all?client={client_id}")
+    return get_url(session, f"{API_VERSION}/episodes/all?client={client_id}", stream=True, cache=True)
 
 
 def get_all_releases(session, client_id):
-    return get_url(session, f"{API_VERSION}/releases/all?client={client_id}")
+    return get_url(session, f"{API_VERSION}/releases/all?client={client_id}", stream=True, cache=True)
 
 
 # Sync
@@ -61,10 +75,274 @@ def make_ids(ids):
     return ",".join(map(str, ids))
 
 
-def get_url(session, path):
+def get_ids_max_length(client_id):
+    """
+    Return how many bytes are left for the ids list in the longest request URL
+    """
+    url = urljoin(current_app.config.get('API_BASE_URL', DEFAULT_API_BASE_URL), f"{API_VERSION}/series-tags?ids=&client={client_id}")
+    return MAX_URL_LENGTH - len(url)
+
+
+def iter_id_chunks(ids, chunk_sizer, max_length):
+    """
+    Split ids in chunks which fit into max_length bytes once joined, 
+      each chunk size is decided when it is requested, so it follows 
+      the latest chunk_sizer adjustments. Yields chunk offset and ids
+    """
+    start = 0
+    while start < len(ids):
+        max_count = chunk_sizer.size
+        end, length = start, 0
+        while end < len(ids) and end - start < max_count:
+            # Separator is needed after the first id
+            id_length = len(str(ids[end])) + (1 if end > start else 0)
+            if length + id_length > max_length and end > start:
+                break
+            length += id_length
+            end += 1
+        yield start, ids[start:end]
+        start = end
+
+
+class ChunkSizer(object):
+    """
+    Adapt the number of ids per request to the observed server 
+      response times: grow while responses are fast and shrink 
+      when they are slow or time out
+    """
+
+    def __init__(self, size=INITIAL_CHUNK_SIZE):
+        self.size = size
+        self.lock = Lock()
+
+    def on_response(self, elapsed):
+        if elapsed < FAST_RESPONSE_TIME:
+            self._resize(1.25)
+        elif elapsed > SLOW_RESPONSE_TIME:
+            self._resize(0.75)
+
+    def on_timeout(self):
+        self._resize(0.5)
+
+    def _resize(self, factor):
+        # Requests run on several threads
+        with self.lock:
+            self.size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, int(self.size * factor)))
+
+
+def get_url(session, path, stream=False, cache=False):
     request_headers = {
-        'User-Agent': USER_AGENT
+        'User-Agent': USER_AGENT,
+        # Decoded while streaming by urllib3
+        'Accept-Encoding': 'gzip, deflate',
     }
     url = urljoin(current_app.config.get('API_BASE_URL', DEFAULT_API_BASE_URL), path)
+    if cache:
+        cache_entry = ResponseCache(current_app.config['API_CACHE_DIR'], path)
+        request_headers.update(cache_entry.get_conditional_headers())
     current_app.logger.debug(f"Quering API endpoint {url}...")
-    return session.get(url, timeout=TIMEOUT, headers=request_headers)
+    response = session.get(url, timeout=TIMEOUT, headers=request_headers, stream=stream or cache)
+    if cache:
+        return cache_entry.handle_response(response)
+    return response
+
+# Response cache
+
+
+class ResponseCache(object):
+    """
+    On-disk copy of the full import response still in progress, 
+      revalidated with its ETag so resuming an interrupted stage 
+      costs a 304 instead of downloading it again
+    """
+
+    def __init__(self, cache_dir, path):
+        self.cache_dir = Path(cache_dir)
+        self.body_path = self.cache_dir.joinpath(f"{get_cache_key(path)}.json")
+        self.meta_path = self.cache_dir.joinpath(f"{get_cache_key(path)}.meta")
+
+    def get_conditional_headers(self):
+        headers = {}
+        meta = self._load_meta()
+        if meta and meta.get('etag') and self.body_path.exists():
+            headers['If-None-Match'] = meta['etag']
+        return headers
+
+    def handle_response(self, response):
+        # Completed stages are covered by import checkpoints, drop their copies
+        clear_response_cache(self.cache_dir, keep=self.body_path)
+        if response.status_code == 304 and self.body_path.exists():
+            current_app.logger.debug(f"Endpoint data is not modified, using cached copy {self.body_path}")
+            response.close()
+            return self._make_cached_response(response)
+        if response.status_code == 200 and 'ETag' in response.headers:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Save data to disk while it is consumed
+            response.raw = CachingReader(response.raw, self, {'etag': response.headers['ETag']})
+        return response
+
+    def save(self, temp_path, meta):
+        os.replace(temp_path, self.body_path)
+        with open(self.meta_path, "w") as f:
+            json.dump(meta, f)
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _make_cached_response(self, not_modified_response):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = not_modified_response.url
+        response.request = not_modified_response.request
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Content-Length'] = str(self.body_path.stat().st_size)
+        response.raw = open(self.body_path, "rb")
+        response.from_cache = True
+        return response
+
+
+class CachingReader(object):
+    """
+    Wrap a urllib3 response and write the decoded data 
+      into the cache while it is streamed
+    """
+
+    def __init__(self, raw, cache_entry, meta):
+        self.raw = raw
+        self.cache_entry = cache_entry
+        self.meta = meta
+        self.temp_path = cache_entry.body_path.with_suffix(".tmp")
+        self.file = open(self.temp_path, "wb")
+
+    def stream(self, amt, decode_content=True):
+        for chunk in self.raw.stream(amt, decode_content=True):
+            self.file.write(chunk)
+            yield chunk
+        # Response was read to the end
+        self.file.close()
+        self.cache_entry.save(self.temp_path, self.meta)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def release_conn(self):
+        self.raw.release_conn()
+
+    def close(self):
+        self.raw.close()
+        if not self.file.closed:
+            # Discard incomplete data
+            self.file.close()
+            os.remove(self.temp_path)
+
+
+def clear_response_cache(cache_dir, keep=None):
+    """
+    Remove every cached response but keep, once the import stage 
+      they were kept for has been completed
+    """
+    for body_path in Path(cache_dir).glob("*.json"):
+        if body_path != keep:
+            remove_cache_entry(body_path)
+
+
+def remove_cache_entry(body_path):
+    for path in [body_path, body_path.with_suffix(".meta")]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_cache_key(path):
+    # Client id does not change the returned data
+    pieces = urlsplit(path)
+    query = urlencode([(key, value) for key, value in parse_qsl(pieces.query) if key != 'client'])
+    return re.sub(r"[^a-zA-Z0-9]+", "-", f"{pieces.path}?{query}").strip("-")
+
+# Streaming
+
+
+def iter_json_batches(response, batch_size):
+    """
+    Decode a JSON array response incrementally, yielding lists of 
+      at most batch_size items together with the percent of the 
+      response body read so far (or None if the size is unknown)
+    """
+    content_length = int(response.headers.get('Content-Length', 0))
+    batch = []
+    for item in iter_json_array(response):
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch, get_read_percent(response, content_length)
+            batch = []
+    if batch:
+        yield batch, get_read_percent(response, content_length)
+
+
+def iter_json_array(response):
+    """
+    Yield each item of a top-level JSON array without loading the 
+      whole response body in memory
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    chunks = response.iter_content(chunk_size=READ_CHUNK_SIZE)
+    buffer, pos = "", 0
+    array_started = False
+    for chunk in chunks:
+        buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        while True:
+            # Skip whitespace and separators between items
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not array_started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"Expected a JSON array, got '{buffer[pos]}' instead")
+                array_started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                # Consume the rest of the response, so it can be cached
+                for _ in chunks:
+                    pass
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Item is incomplete, wait for the next chunk
+                break
+            # Make sure a trailing number is not truncated by the chunk boundary
+            if end == len(buffer):
+                break
+            yield item
+            pos = end
+    raise ValueError("Unexpected end of JSON array")
+
+
+def get_response_size(response):
+    """
+    Return the bytes actually received from the network for 
+      the response body, before any content decoding
+    """
+    if getattr(response, 'from_cache', False):
+        return 0
+    try:
+        return response.raw.tell()
+    except AttributeError:
+        return 0
+
+
+def get_read_percent(response, content_length):
+    if not content_length:
+        return None
+    # Bytes read from the wire, before any content decoding
+    return min(100, int(response.raw.tell() / content_length * 100))
@@ -256,7 +256,7 @@ class BitTorrentClient(Thread):
 
     def on_metadata_received_alert(self, handle):        
         transfer = Transfer(handle.status())
-        models.update_torrent(transfer.info_hash, status=models.TORRENT_DOWNLOADING, file_storage=transfer.file_storage)
+        models.write(models.update_torrent, transfer.info_hash, status=models.TORRENT_DOWNLOADING, file_storage=transfer.file_storage)
         # See https://libtorrent.org/reference-Torrent_Handle.html#torrent-file-with-hashes-torrent-file
         torrent_file = handle.torrent_file()
         if torrent_file:
@@ -269,7 +269,7 @@ class BitTorrentClient(Thread):
     def on_save_resume_data_alert(self, alert):
         info_hash = str(alert.handle.info_hash())
         data = lt.write_resume_data_buf(alert.params)
-        did_update = models.update_torrent(info_hash, resume_data=data)
+        did_update = models.write(models.update_torrent, info_hash, resume_data=data)
         if did_update:
             self.app.logger.debug(f"Saved resume data for {alert.torrent_name} torrent")
         # Check if torrent can be paused
@@ -290,7 +290,7 @@ class BitTorrentClient(Thread):
         print(f'Downloaded torrent {transfer.name}')
         # Remove TZ or Peewee will save it as string in SQLite
         utc_now = datetime.now(timezone.utc).replace(tzinfo=None)
-        _ = models.update_torrent(transfer.info_hash, status=models.TORRENT_DOWNLOADED, downloaded_on=utc_now)
+        _ = models.write(models.update_torrent, transfer.info_hash, status=models.TORRENT_DOWNLOADED, downloaded_on=utc_now)
         torrent_file = handle.torrent_file()
         if torrent_file:
             self._rename_files(handle, torrent_file.orig_files(), suffix='')
@@ -307,7 +307,7 @@ class BitTorrentClient(Thread):
 
     def add_torrent(self, release):
         try:
-            new_torrent = models.add_torrent(release)
+            new_torrent = models.write(models.add_torrent, release)
         except peewee.IntegrityError:
             self.app.logger.warning(f"Could not add torrent, '{release}' already in download queue")
             return
@@ -322,7 +322,7 @@ class BitTorrentClient(Thread):
             self.session.remove_torrent(torrent_handle, delete_files)
         # else:
         #     raise BitTorrentClientError(f'Invalid torrent handle for {info_hash}')
-        did_remove = models.remove_torrent(info_hash)      
+        did_remove = models.write(models.remove_torrent, info_hash)      
         if did_remove:
             self.app.logger.debug(f"Removed torrent {info_hash}") 
         return did_remove
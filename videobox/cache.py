@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_CACHE_SIZE = 8*1024*1024  # Characters of rendered HTML
+
+# The only page cache, replaced when the app is created
+page_cache = None
+
+
+class PageCache(object):
+    """
+    Keep rendered page fragments until library changes, dropping the
+      least recently used ones when cache grows over max_size
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        # Bumped by sync and scraper each time library changes
+        self.generation = 0
+        self.fragments = OrderedDict()
+        # Few small values, not counted in size
+        self.values = {}
+        self.lock = Lock()
+
+    def get(self, key, render):
+        """
+        Return the fragment cached for key, calling render to create it
+          if missing. Key must be hashable and include every request
+          argument which changes the fragment
+        """
+        with self.lock:
+            generation = self.generation
+            fragment = self.fragments.get((generation, key))
+            if fragment is not None:
+                self.fragments.move_to_end((generation, key))
+                return fragment
+
+        # Render without the lock, concurrent misses may render twice
+        fragment = render()
+        size = len(fragment)
+        with self.lock:
+            # Library changed while rendering, do not keep stale fragment around
+            if generation != self.generation or size > self.max_size:
+                return fragment
+            previous = self.fragments.pop((generation, key), None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.fragments[(generation, key)] = fragment
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.fragments.popitem(last=False)
+                self.size -= len(evicted)
+        return fragment
+
+    def memo(self, key, compute):
+        """
+        Return the value computed for key since last library change,
+          calling compute to get it if missing
+        """
+        with self.lock:
+            generation = self.generation
+            if key in self.values:
+                return self.values[key]
+
+        value = compute()
+        with self.lock:
+            if generation == self.generation:
+                self.values[key] = value
+        return value
+
+    def bump(self):
+        """
+        Signal library has changed and forget every cached fragment and value
+        """
+        with self.lock:
+            self.generation += 1
+            self.fragments.clear()
+            self.values.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.fragments)
@@ -1,8 +1,8 @@
 import operator
 from functools import reduce
 from datetime import datetime, date, timedelta, timezone
-from peewee import fn
-from videobox.models import Series, Episode, Release, Torrent, Tag, SeriesTag, SeriesIndex, TAG_GENRE, TORRENT_DOWNLOADED
+from peewee import fn, SQL, Tuple
+from videobox.models import Series, Episode, Release, Torrent, Tag, SeriesTag, SeriesIndex, EpisodeIndex, TAG_GENRE, TORRENT_DOWNLOADED, RANKING_SEEDERS, RANKING_SMALLEST, RANKING_LARGEST
 
 MAX_SEASONS = 2
 
@@ -41,23 +41,13 @@ def get_top_tags(limit):
             .objects()
             )
 
-def get_series_subquery():
-    SeriesAlias = Series.alias()
-    return (SeriesAlias.select(SeriesAlias.id, fn.Max(Episode.season).alias("max_season"))
-            .join(Episode)
-            .group_by(SeriesAlias.id))
-
-
 def get_featured_series(exclude_ids, days_interval):
-    series_subquery = get_series_subquery()
     return (Series.select(Series, fn.Sum(Release.completed).alias('total_completed'))
             .join(Episode)
             .join(Release)
-            .join(series_subquery, on=(
-                series_subquery.c.id == Series.id))
             # Consider episodes from last season only and releases within interval days
             .where(~(Series.id << exclude_ids) & 
-                   (Episode.season == series_subquery.c.max_season) &
+                   (Episode.season == Series.max_season) &
                    (Release.added_on > (date.today() - timedelta(days=days_interval))))
             .group_by(Series)
             .order_by(fn.Sum(Release.completed).desc())
@@ -65,14 +55,11 @@ def get_featured_series(exclude_ids, days_interval):
 
 
 def get_today_series(limit):
-    series_subquery = get_series_subquery()
     return (Series.select(Series, Episode, fn.SUM(Release.completed).alias('total_completed'))
             .join(Episode)
             .join(Release)
-            .join(series_subquery, on=(
-                series_subquery.c.id == Series.id))
             # Consider episodes from last season only and releases within the past 24h
-            .where((Episode.season == series_subquery.c.max_season) &
+            .where((Episode.season == Series.max_season) &
                    (Episode.thumbnail_url != '') &
                    # @@TODO do not user current time, figure out max added_on and compute from it
                    (Release.added_on > (datetime.now(timezone.utc) - timedelta(hours=24))))
@@ -82,10 +69,11 @@ def get_today_series(limit):
             )
 
 def get_followed_series(days=None):
-    series_subquery = get_series_subquery()
     where_clauses = [
         # Only episodes from the last season        
-        (Episode.season == series_subquery.c.max_season),
+        (Episode.season == Series.max_season),
+        # Start from the few followed series, whatever planner statistics say
+        (Series.id << Series.select(Series.id).where(Series.followed_since.is_null(False))),
         (fn.strftime('%Y-%m-%d', Release.added_on) >= Series.followed_since)
     ]
     if days:
@@ -94,8 +82,6 @@ def get_followed_series(days=None):
     q = (Series.select(Series, Episode, fn.strftime('%Y-%m-%d', Release.added_on).alias("added_on_date"), fn.Count(Release.id).alias("release_count"))
          .join(Episode)
          .join(Release)
-         .join(series_subquery, on=(
-             series_subquery.c.id == Series.id))
          # Chain all conditions together AND'ing them 
          #  https://github.com/coleifer/peewee/issues/391#issuecomment-468042229
          .where(reduce(operator.and_, where_clauses))
@@ -107,16 +93,13 @@ def get_followed_series(days=None):
 
 def get_top_series_for_tags():
     # Grab all tags and associated series with releases for the last two seasons
-    subquery = get_series_subquery()
     return (Series.select(Series, Tag.slug.alias('tag_slug'), Tag.name.alias('tag_name'))
             .join(SeriesTag)
             .join(Tag)
             .switch(Series)
             .join(Episode)
             .join(Release)
-            .join(subquery, on=(
-                subquery.c.id == Series.id))
-            .where((Tag.type == TAG_GENRE) & (subquery.c.max_season-Episode.season < MAX_SEASONS))
+            .where((Tag.type == TAG_GENRE) & (Series.max_season-Episode.season < MAX_SEASONS))
             .group_by(Tag.name, Series.id)
             .order_by(Tag.name, Series.popularity.desc())
             # Reconstruct objects graph 
@@ -124,60 +107,67 @@ def get_top_series_for_tags():
             )
 
 
-def get_series_for_tag(tag, sorting):
+def get_series_for_tag(tag, sorting, after_id=None):
     # TODO https://michaelsoolee.com/case-insensitive-sorting-sqlite/
     # https://stackoverflow.com/questions/27051013/using-collate-on-peewee-queries
     # https://github.com/coleifer/peewee/issues/1111
     #sort_name_collated = Clause(Series.sort_name, SQL('COLLATE NOCASE'))
-    sorting_expr = Series.sort_name
+    sort_keys, descending = operator.attrgetter('sort_name', 'id'), False
     if sorting == 'popularity':
-        sorting_expr = Series.popularity.desc()
+        sort_keys, descending = operator.attrgetter('popularity', 'id'), True
     elif sorting == 'desc':
-        sorting_expr = Series.sort_name.desc()
+        descending = True
 
-    subquery = get_series_subquery()
-    return (Series.select(Series)
-            .join(SeriesTag)
-            .switch(Series)
-            .join(Episode)
-            .join(Release)
-            .join(subquery, on=(
-                subquery.c.id == Series.id))
-            .where((SeriesTag.tag == tag) & (subquery.c.max_season-Episode.season < MAX_SEASONS))
-            .order_by(sorting_expr)
-            .group_by(Series.id)
-            )
+    query = (Series.select(Series)
+             .join(SeriesTag)
+             .where(SeriesTag.tag == tag))
+    # Check releases last, on the series following after_id only
+    return paginate_after(query, sort_keys, descending, after_id).where(has_recent_releases())
 
 
-def get_series_for_language(language):
-    subquery = get_series_subquery()
-    return (Series.select(Series)
-            .switch(Series)
-            .join(Episode)
-            .join(Release)
-            .join(subquery, on=(
-                subquery.c.id == Series.id))
-            .where((Series.language == language) & (subquery.c.max_season-Episode.season < MAX_SEASONS))
-            .order_by(fn.Lower(Series.sort_name))
-            .group_by(Series.id)
-            )
+def get_series_for_language(language, after_id=None):
+    query = (Series.select(Series)
+             .where(Series.language == language))
+    return paginate_after(query, lambda model: (fn.Lower(model.sort_name), model.id), False, after_id).where(has_recent_releases())
 
 
-def release_cte(resolution, size_sorting):
+def has_recent_releases():
+    # Series with any release for the last two seasons
+    return fn.EXISTS(Episode.select(SQL('1'))
+                     .join(Release)
+                     .where((Episode.series == Series.id) & (Series.max_season-Episode.season < MAX_SEASONS)))
+
+
+def paginate_after(query, sort_keys, descending, after_id):
+    """
+    Order series by sort_keys(model) and return the ones following after_id,
+      so deeper pages do not need to skip over the previous ones
+    """
+    keys = sort_keys(Series)
+    if after_id:
+        # Compare with keys of the last series already shown using row values
+        LastSeries = Series.alias()
+        last_keys = LastSeries.select(*sort_keys(LastSeries)).where(LastSeries.id == after_id)
+        query = query.where((Tuple(*keys) < last_keys) if descending else (Tuple(*keys) > last_keys))
+    return query.order_by(*[key.desc() if descending else key for key in keys])
+
+
+def get_release_ranking(size_sorting):
     if size_sorting == "asc":
-        aggr_fn = fn.Min(Release.size).alias("size")
+        return RANKING_SMALLEST
     elif size_sorting == "desc":
-        aggr_fn= fn.Max(Release.size).alias("size")
-    else:
-        # Default to sorting by seeders
-        aggr_fn = fn.Max(Release.seeders).alias("max_seeders") 
-
-    query = (Release.select(Release.id.alias('release_id'), aggr_fn)
-             .join(Episode)
-             .where((Release.resolution == resolution) if resolution else True)
-             .group_by(Episode.id)
-             .cte('best_release'))
-    return query
+        return RANKING_LARGEST
+    # Default to sorting by seeders
+    return RANKING_SEEDERS
+
+
+def get_series_torrents(series):
+    return (Torrent.select(Torrent.release, Torrent.status)
+            .join(Release)
+            .join(Episode)
+            .where(Episode.series == series.id)
+            .order_by(Torrent.release)
+            .tuples())
 
 
 def get_series_with_ids(ids):
@@ -201,3 +191,22 @@ def suggest_series(query):
              .where(SeriesIndex.name.match(f"{query}*"))
              .order_by(SeriesIndex.bm25()))
     return query
+
+
+def search_episodes(query):
+    return (Episode.select(Episode, Series)
+            .join_from(Episode, Series)
+            .join_from(Episode, EpisodeIndex, on=(Episode.id == EpisodeIndex.rowid))
+            # Series detail only lists the latest seasons
+            .where(EpisodeIndex.match(f"{query}*") & (Series.max_season-Episode.season < MAX_SEASONS))
+            # Name matches count more than overview ones
+            .order_by(EpisodeIndex.bm25(2.0, 1.0)))
+
+
+def suggest_episodes(query):
+    return (Episode.select(Episode, Series)
+            .join_from(Episode, Series)
+            .join_from(Episode, EpisodeIndex, on=(Episode.id == EpisodeIndex.rowid))
+            # Series detail only lists the latest seasons
+            .where(EpisodeIndex.name.match(f"{query}*") & (Series.max_season-Episode.season < MAX_SEASONS))
+            .order_by(EpisodeIndex.bm25()))
@@ -4,15 +4,20 @@ from itertools import groupby
 from pathlib import Path
 import shutil
 import re
+import hashlib
+import uuid
 import flask
 from flask import current_app as app
+from markupsafe import Markup
 from peewee import fn, JOIN
-from playhouse.flask_utils import PaginatedQuery, get_object_or_404
+from playhouse.flask_utils import get_object_or_404
 import videobox
 import videobox.bt as bt
+import videobox.cache as cache
+import videobox.sync as sync
 import videobox.models as models
 import videobox.scraper as scraper
-from videobox.models import Series, Episode, Release, Tag, SeriesTag, SyncLog, Tracker, Torrent
+from videobox.models import Series, Episode, Release, BestRelease, Tag, SeriesTag, SyncLog, Tracker, Torrent
 from . import bp
 # from .announcer import announcer
 from . import queries
@@ -22,6 +27,9 @@ MAX_TOP_TAGS = 8
 MIN_SEEDERS = 1
 MAX_SEASONS = 2
 MAX_LOG_ROWS = 5
+MAX_SYNC_LOG_ROWS = 30
+MAX_FOUND_EPISODES = 50
+MAX_SUGGESTIONS = 10
 SERIES_CARDS_PER_PAGE = 6 * 10
 SERIES_EPISODES_PER_PAGE = 30
 RESOLUTION_OPTIONS = {
@@ -42,6 +50,8 @@ RESOLUTION_FILTER_COOKIE = 'filter-video-resolution'
 SIZE_SORTING_COOKIE = 'size-sorting'
 EPISODE_SORTING_COOKIE = "episode-sorting"
 LAST_DOWNLOAD_SEEN_COOKIE = 'downloads-last-seen-on'
+# Changes on each start, so ETags given out by a previous run never match
+ETAG_SALT = uuid.uuid4().hex
 
 @bp.context_processor
 def inject_template_vars():
@@ -64,34 +74,55 @@ last_server_alert = ''
 
 @bp.route('/')
 def home():
-    total_series, total_releases = queries.get_library_stats()
+    total_series, total_releases = cache.page_cache.memo("library-stats", queries.get_library_stats)
     # Make sure library is already filled with data
-    if total_series and total_releases:        
-        utc_now = datetime.now(timezone.utc)        
+    if total_series and total_releases:
+        utc_now = datetime.now(timezone.utc)
         recent_downloads_count = get_recent_downloads_count(utc_now)
         last_sync = models.get_last_log()
-        today_series = queries.get_today_series(10)
-        # Do not exclude any series for now
-        exclude_ids = []
-        featured_series = queries.get_featured_series(exclude_ids=exclude_ids, days_interval=2).limit(8)
-        top_tags = queries.get_top_tags(MAX_TOP_TAGS)
-        # Show updates within the last week
-        followed_series = queries.get_followed_series(days=7)
-        return flask.render_template("home.html", 
+        # Lists of the last day and week go stale even if library does not change
+        content = cache.page_cache.get(("home", date.today(), utc_now.hour), render_home_content)
+        return flask.render_template("home.html",
                                      current_page="home",
+                                     content=content,
                                      last_sync=last_sync,
                                      utc_now=utc_now,
                                      server_alert=last_server_alert,
-                                     today_series=today_series,
-                                     featured_series=featured_series, 
-                                     top_tags=top_tags,
                                      total_series=total_series,
                                      total_releases=total_releases,
-                                     recent_downloads_count=recent_downloads_count,
-                                     followed_series=followed_series)
+                                     recent_downloads_count=recent_downloads_count)
     else:
         return flask.render_template("first-import.html")
 
+def render_home_content():
+    today_series = queries.get_today_series(10)
+    # Do not exclude any series for now
+    exclude_ids = []
+    featured_series = queries.get_featured_series(exclude_ids=exclude_ids, days_interval=2).limit(8)
+    top_tags = queries.get_top_tags(MAX_TOP_TAGS)
+    # Show updates within the last week
+    followed_series = queries.get_followed_series(days=7)
+    return Markup(flask.render_template("_home.html",
+                                        today_series=today_series,
+                                        featured_series=featured_series,
+                                        top_tags=top_tags,
+                                        followed_series=followed_series))
+
+@bp.route('/sync/log')
+def sync_log():
+    sync_logs = models.get_sync_logs(MAX_SYNC_LOG_ROWS)
+    return flask.render_template("sync_log.html", 
+                                 utc_now=datetime.now(timezone.utc),
+                                 sync_logs=sync_logs)
+
+@bp.route('/sync', methods=['POST'])
+def sync_now():
+    if not (sync.sync_worker and sync.sync_worker.is_alive()):
+        flask.abort(503)
+    # Sync worker still enforces the min. interval between syncs
+    sync.sync_worker.wake()
+    return ('', 202)
+
 
 @bp.route('/download/<int:release_id>', methods=['POST'])
 def download_torrent(release_id):
@@ -157,21 +188,29 @@ def search():
         release = get_object_or_404(Release, (Release.info_hash==query.lower()))
         return flask.redirect(flask.url_for('.series_detail', series_id=release.episode.series.id, view="list", _anchor=f"r{release.info_hash}"))
     else:
-        series_ids = [series.rowid for series in queries.search_series(
-            sanitize_query(query))]
+        sanitized_query = sanitize_query(query)
+        series_ids = [series.rowid for series in queries.search_series(sanitized_query)]
         series = queries.get_series_with_ids(series_ids)
+        episodes = list(queries.search_episodes(sanitized_query).limit(MAX_FOUND_EPISODES))
         if len(series) == 1:
             return flask.redirect(flask.url_for('.series_detail', series_id=series[0].id))        
+        elif not series and len(episodes) == 1:
+            return redirect_to_episode(episodes[0])
         else:
             utc_now = datetime.now(timezone.utc)
             recent_downloads_count = get_recent_downloads_count(utc_now)    
             return flask.render_template("search_results.html", 
                                          current_page="search",
                                          found_series=series, 
+                                         found_episodes=episodes,
                                          search_query=query,
                                          recent_downloads_count=recent_downloads_count)
 
 
+def redirect_to_episode(episode):
+    return flask.redirect(flask.url_for('.series_detail', series_id=episode.series.id, _anchor=f"e{episode.id}"))
+
+
 def is_info_hash(value):
     return RE_INFO_HASH.match(value)
 
@@ -182,8 +221,9 @@ def suggest():
     if not query:
         flask.abort(400)
     sanitized_query = sanitize_query(query)
-    search_suggestions = queries.suggest_series(sanitized_query).limit(10)
-    return flask.render_template("_suggest.html", search_suggestions=search_suggestions)
+    search_suggestions = queries.suggest_series(sanitized_query).limit(MAX_SUGGESTIONS)
+    episode_suggestions = queries.suggest_episodes(sanitized_query).limit(MAX_SUGGESTIONS)
+    return flask.render_template("_suggest.html", search_suggestions=search_suggestions, episode_suggestions=episode_suggestions)
 
 
 # ---------
@@ -191,38 +231,55 @@ def suggest():
 # ---------
 
 @bp.route('/tag')
-def tag():    
+def tag():
     utc_now = datetime.now(timezone.utc)
-    recent_downloads_count = get_recent_downloads_count(utc_now)        
-    tags_all = queries.get_top_series_for_tags()
-    tags_series = groupby(tags_all, key=attrgetter('tag_slug', 'tag_name'))
-    return flask.render_template("tags.html", 
+    recent_downloads_count = get_recent_downloads_count(utc_now)
+    content = cache.page_cache.get(("tags",), render_tags_content)
+    return flask.render_template("tags.html",
                                  current_page="tag",
-                                 tags_series=tags_series, 
+                                 content=content,
                                  recent_downloads_count=recent_downloads_count)
 
+def render_tags_content():
+    tags_all = queries.get_top_series_for_tags()
+    tags_series = groupby(tags_all, key=attrgetter('tag_slug', 'tag_name'))
+    return Markup(flask.render_template("_tags.html", tags_series=tags_series))
+
 
 @bp.route('/tag/<slug>')
 def tag_detail(slug):
-    page = flask.request.args.get("page", 1, type=int)
+    # Last series of previous page
+    after_id = flask.request.args.get("after", type=int)
     tag = get_object_or_404(Tag, (Tag.slug == slug))
     series_sorting = flask.request.args.get("sort", default="popularity")
-    query = queries.get_series_for_tag(tag, series_sorting)
-    paginated_series = PaginatedQuery(query, paginate_by=SERIES_CARDS_PER_PAGE, page_var="page", check_bounds=True)
-    if page == 1:
-        utc_now = datetime.now(timezone.utc)
-        recent_downloads_count = get_recent_downloads_count(utc_now)        
-        return flask.render_template("tag_detail.html", 
-                                     current_page="tag",
-                                     tag=tag, 
-                                     series=paginated_series, 
-                                     page=page, 
-                                     series_count=query.count(), 
-                                     series_sorting=series_sorting, 
-                                     recent_downloads_count=recent_downloads_count)
-    else:
-        # For async requests
-        return flask.render_template("_tag-card-grid.html", tag=tag, series=paginated_series, page=page, series_sorting=series_sorting)
+
+    def render_content():
+        series, next_after_id = get_series_page(queries.get_series_for_tag(tag, series_sorting, after_id))
+        if not after_id:
+            return Markup(flask.render_template("_tag-detail.html",
+                                                tag=tag,
+                                                series=series,
+                                                next_after_id=next_after_id,
+                                                series_count=queries.get_series_for_tag(tag, series_sorting).count(),
+                                                series_sorting=series_sorting))
+        else:
+            # For async requests
+            return flask.render_template("_tag-card-grid.html", tag=tag, series=series, next_after_id=next_after_id, series_sorting=series_sorting)
+
+    def render_page():
+        content = cache.page_cache.get(("tag", slug, series_sorting, after_id), render_content)
+        if not after_id:
+            return flask.render_template("tag_detail.html",
+                                         current_page="tag",
+                                         tag=tag,
+                                         content=content,
+                                         recent_downloads_count=recent_downloads_count)
+        else:
+            return content
+
+    utc_now = datetime.now(timezone.utc)
+    recent_downloads_count = get_recent_downloads_count(utc_now)
+    return conditional_response(get_etag(recent_downloads_count), render_page)
 
 # ---------
 # Languages
@@ -230,21 +287,34 @@ def tag_detail(slug):
 
 @bp.route('/language/<code>')
 def language_detail(code):
-    page = flask.request.args.get("page", 1, type=int)
-    query = queries.get_series_for_language(code)
-    paginated_series = PaginatedQuery(query, paginate_by=SERIES_CARDS_PER_PAGE, page_var="page", check_bounds=True)
-    if page == 1:
-        utc_now = datetime.now(timezone.utc)
-        recent_downloads_count = get_recent_downloads_count(utc_now)               
-        return flask.render_template("language_detail.html", 
-                                     language=code, 
-                                     series=paginated_series, 
-                                     page=page, 
-                                     series_count=query.count(),
-                                     recent_downloads_count=recent_downloads_count)
-    else:
-        # For async requests
-        return flask.render_template("_language-card-grid.html", language=code, series=paginated_series, page=page)
+    # Last series of previous page
+    after_id = flask.request.args.get("after", type=int)
+
+    def render_content():
+        series, next_after_id = get_series_page(queries.get_series_for_language(code, after_id))
+        if not after_id:
+            return Markup(flask.render_template("_language-detail.html",
+                                                language=code,
+                                                series=series,
+                                                next_after_id=next_after_id,
+                                                series_count=queries.get_series_for_language(code).count()))
+        else:
+            # For async requests
+            return flask.render_template("_language-card-grid.html", language=code, series=series, next_after_id=next_after_id)
+
+    def render_page():
+        content = cache.page_cache.get(("language", code, after_id), render_content)
+        if not after_id:
+            return flask.render_template("language_detail.html",
+                                         language=code,
+                                         content=content,
+                                         recent_downloads_count=recent_downloads_count)
+        else:
+            return content
+
+    utc_now = datetime.now(timezone.utc)
+    recent_downloads_count = get_recent_downloads_count(utc_now)
+    return conditional_response(get_etag(recent_downloads_count), render_page)
 
 
 # --------- 
@@ -274,70 +344,79 @@ def _series_detail(series):
     view_layout = flask.request.args.get("view", default="grid")
     is_async = flask.request.args.get("async", type=int, default=0) == 1
     today = date.today()
-    series_subquery = queries.get_series_subquery()
-    release_cte = queries.release_cte(resolution_filter, size_sorting)
-    if resolution_filter or size_sorting != "any":
-        # Filtered
-        episodes_query = (Episode.select(Episode, Release, Torrent)
-                          .join(Release)
-                          .join(Torrent, JOIN.LEFT_OUTER)
-                          .switch(Episode)
-                          .join(Series)
-                          .join(series_subquery, on=(
-                              series_subquery.c.id == Series.id))
-                          .join(release_cte, on=(Release.id == release_cte.c.release_id))
-                          .where((Episode.series == series.id) &
-                                 # Episodes from last 2 seasons only
-                                 (series_subquery.c.max_season - Episode.season < MAX_SEASONS) 
-                                 )
-                          .order_by(Episode.season.desc(), Episode.number if episode_sorting == "asc" else Episode.number.desc())
-                          .with_cte(release_cte))
-    else:
-        # Unfiltered
-        episodes_query = (Episode.select(Episode, Release, Torrent)
-                          .join(Release, JOIN.LEFT_OUTER)
-                          .join(Torrent, JOIN.LEFT_OUTER)
-                          .switch(Episode)
-                          .join(Series)
-                          .join(series_subquery, on=(
-                              series_subquery.c.id == Series.id))
-                          .where((Episode.series == series.id) &
-                                 # Episodes from last 2 seasons only
-                                 (series_subquery.c.max_season - Episode.season < MAX_SEASONS) 
-                                 )
-                          .order_by(Episode.season.desc(), Episode.number if episode_sorting == "asc" else Episode.number.desc(), Release.seeders.desc()))
-
-    filter_message = 'Showing torrents '
-    if resolution_filter > 0:
-        filter_message += f'with {resolution_filter}p video resolution and '
-    else:
-        filter_message += 'with any video resolution and '
-    if size_sorting == 'asc':        
-        filter_message += 'smallest file sizes, regardless of seeded numbers' 
-    elif size_sorting == 'desc':
-        filter_message += 'largest file sizes, regardless of seeded numbers'
-    else:
-        filter_message += 'ranked by seeded numbers'
-
-    # Group by season number
-    seasons_episodes = groupby(episodes_query, key=attrgetter('season'))
-    series_tags = queries.get_series_tags(series) 
-    template = "_episodes.html" if is_async else "series_detail.html"
-    response = flask.make_response(flask.render_template(template, 
-                                                         allow_downloads=True if bt.torrent_worker else False,
-                                                         series=series, 
-                                                         series_tags=series_tags, 
-                                                         seasons_episodes=seasons_episodes, 
-                                                         today=today, 
-                                                         resolution=resolution_filter, 
-                                                         resolution_options=RESOLUTION_OPTIONS, 
-                                                         size=size_sorting, 
-                                                         size_options=SIZE_OPTIONS,
-                                                         episode_sorting=episode_sorting,
-                                                         view_layout=view_layout,
-                                                         torrent_running=torrent_running(),
-                                                         recent_downloads_count=recent_downloads_count,
-                                                         filter_message=filter_message))
+    allow_downloads = True if bt.torrent_worker else False
+    is_torrent_running = torrent_running()
+
+    def render_page():
+        if resolution_filter or size_sorting != "any":
+            # Filtered
+            ranking = queries.get_release_ranking(size_sorting)
+            episodes_query = (Episode.select(Episode, Release, Torrent)
+                              .join(Release)
+                              .join(BestRelease, on=((BestRelease.episode == Episode.id) &
+                                                     (BestRelease.resolution == resolution_filter) &
+                                                     (BestRelease.ranking == ranking) &
+                                                     (BestRelease.release == Release.id)))
+                              .switch(Release)
+                              .join(Torrent, JOIN.LEFT_OUTER)
+                              .switch(Episode)
+                              .join(Series)
+                              .where((Episode.series == series.id) &
+                                     # Episodes from last 2 seasons only
+                                     (Series.max_season - Episode.season < MAX_SEASONS)
+                                     )
+                              .order_by(Episode.season.desc(), Episode.number if episode_sorting == "asc" else Episode.number.desc()))
+        else:
+            # Unfiltered
+            episodes_query = (Episode.select(Episode, Release, Torrent)
+                              .join(Release, JOIN.LEFT_OUTER)
+                              .join(Torrent, JOIN.LEFT_OUTER)
+                              .switch(Episode)
+                              .join(Series)
+                              .where((Episode.series == series.id) &
+                                     # Episodes from last 2 seasons only
+                                     (Series.max_season - Episode.season < MAX_SEASONS)
+                                     )
+                              .order_by(Episode.season.desc(), Episode.number if episode_sorting == "asc" else Episode.number.desc(), Release.seeders.desc()))
+
+        filter_message = 'Showing torrents '
+        if resolution_filter > 0:
+            filter_message += f'with {resolution_filter}p video resolution and '
+        else:
+            filter_message += 'with any video resolution and '
+        if size_sorting == 'asc':
+            filter_message += 'smallest file sizes, regardless of seeded numbers'
+        elif size_sorting == 'desc':
+            filter_message += 'largest file sizes, regardless of seeded numbers'
+        else:
+            filter_message += 'ranked by seeded numbers'
+
+        # Group by season number
+        seasons_episodes = groupby(episodes_query, key=attrgetter('season'))
+        series_tags = queries.get_series_tags(series)
+        template = "_episodes.html" if is_async else "series_detail.html"
+        return flask.render_template(template,
+                                     allow_downloads=allow_downloads,
+                                     series=series,
+                                     series_tags=series_tags,
+                                     seasons_episodes=seasons_episodes,
+                                     today=today,
+                                     resolution=resolution_filter,
+                                     resolution_options=RESOLUTION_OPTIONS,
+                                     size=size_sorting,
+                                     size_options=SIZE_OPTIONS,
+                                     episode_sorting=episode_sorting,
+                                     view_layout=view_layout,
+                                     torrent_running=is_torrent_running,
+                                     recent_downloads_count=recent_downloads_count,
+                                     filter_message=filter_message)
+
+    # Series row tells apart updates coming from sync and following
+    etag = get_etag(series.fingerprint, series.max_season, series.followed_since,
+                    resolution_filter, size_sorting, episode_sorting, today,
+                    allow_downloads, is_torrent_running, recent_downloads_count,
+                    list(queries.get_series_torrents(series)))
+    response = conditional_response(etag, render_page)
     if resolution_filter > 0:
         response.set_cookie(RESOLUTION_FILTER_COOKIE, str(resolution_filter))
     else:
@@ -359,7 +438,9 @@ def series_detail_update(series_id):
     following = flask.request.form.get("following", type=int)
     series = get_object_or_404(Series, (Series.id == series_id))
     series.followed_since = date.today() if following else None
-    series.save()
+    models.write(series.save)
+    # Home page lists followed series
+    cache.page_cache.bump()
 
     # Toggle button
     return flask.render_template("_follow-button.html", series=series)
@@ -464,6 +545,39 @@ def get_recent_downloads_count(utc_now):
         last_seen = utc_now - timedelta(hours=1)
     return queries.get_completed_downloads_count(last_seen)
 
+def get_series_page(query):
+    """
+    Return a page of series cards and the id to continue from, if any
+    """
+    # Ask for one more row to know if there is a next page
+    series = list(query.limit(SERIES_CARDS_PER_PAGE + 1))
+    if len(series) > SERIES_CARDS_PER_PAGE:
+        return series[:SERIES_CARDS_PER_PAGE], series[SERIES_CARDS_PER_PAGE-1].id
+    return series, None
+
+def get_etag(*values):
+    """
+    Return strong ETag for current request, values are whatever else
+      the page depends on beside the library
+    """
+    last_log = models.get_last_log()
+    # Page cache generation is bumped by sync, scraper and following
+    state = (ETAG_SALT, cache.page_cache.generation, last_log.id if last_log else None, flask.request.full_path) + values
+    return hashlib.sha1(repr(state).encode("utf-8")).hexdigest()
+
+def conditional_response(etag, render):
+    # Pages change with following and downloads too, so a sync date 
+    #   cannot tell if they are still fresh: rely on the ETag only
+    if flask.request.if_none_match.contains(etag):
+        # Skip queries and template rendering altogether
+        response = flask.Response(status=304)
+    else:
+        response = flask.make_response(render())
+    response.set_etag(etag)
+    # Make browsers and proxies check with us before reusing a page
+    response.cache_control.no_cache = True
+    return response
+
 def torrent_running():
     return bt.torrent_worker and bt.torrent_worker.is_alive() and bt.torrent_worker.session.is_listening()
 
@@ -1,16 +1,32 @@
 from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import sqlite3
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Lock, current_thread
 from peewee import *
-from playhouse.migrate import migrate, SqliteMigrator
-from playhouse.reflection import Introspector
 from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField, JSONField
 from playhouse.flask_utils import FlaskDB
 from . import iso639
 
-# @@TODO check 
 # SQLite >3.32.0 has a limit of total 32766 max variables (SQLITE_MAX_VARIABLE_NUMBER)
 # https://stackoverflow.com/a/64419474 
 # https://stackoverflow.com/q/35616602
-INSERT_CHUNK_SIZE = 999 // 15   # Series class has the max numbes of fields 
+DEFAULT_MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+SELECT_CHUNK_SIZE = 999         # Ids in a single IN (...) clause
+SEARCH_INDEX_AUTOMERGE = 8      # Index segments of the same size merged together
+DEFAULT_CACHE_SIZE = 16*1024    # KiB of page cache for each connection
+DEFAULT_MMAP_SIZE = 256*1024*1024   # Bytes of database file mapped in memory
+
+STAGE_UPDATES = "updates"
+STAGE_TAGS = "tags"
+STAGE_SERIES = "series"
+STAGE_SERIES_TAGS = "series-tags"
+STAGE_EPISODES = "episodes"
+STAGE_RELEASES = "releases"
+STAGE_SCRAPE = "scrape"
+STAGE_INDEXES = "indexes"
 
 SYNC_STARTED = "S"
 SYNC_ERROR = "E"
@@ -30,6 +46,17 @@ TRACKER_TIMED_OUT = 'T'
 
 TRACKERS_ALIVE = [TRACKER_NOT_CONTACTED, TRACKER_OK, TRACKER_TIMED_OUT]
 
+RANKING_SEEDERS = "S"
+RANKING_SMALLEST = "M"
+RANKING_LARGEST = "L"
+
+# Aggregate picking the best release for each ranking
+RANKING_AGGREGATES = {
+    RANKING_SEEDERS: "MAX(seeders)",
+    RANKING_SMALLEST: "MIN(size)",
+    RANKING_LARGEST: "MAX(size)",
+}
+
 TORRENT_ADDED = "A"
 TORRENT_GOT_METADATA = "M"
 TORRENT_DOWNLOADING = "d"
@@ -39,13 +66,40 @@ TORRENT_ABORTED = "X"
 class AppDB(FlaskDB):
     '''
     Specialised FlaskDB which deals with testing memory 
-      sqlite database, see: https://t.ly/susgy
+      sqlite database, see: https://t.ly/susgy. In pool mode 
+      each serving thread keeps its connection open between 
+      requests, with a warm page and statement cache
     '''
+    def init_app(self, app):
+        super().init_app(app)
+        # Applied to every new connection, without opening one now
+        pragmas = dict(self.database._pragmas or ())
+        pragmas['cache_size'] = -app.config.get('DATABASE_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+        pragmas['mmap_size'] = app.config.get('DATABASE_MMAP_SIZE', DEFAULT_MMAP_SIZE)
+        self.database.init(self.database.database, pragmas=pragmas, timeout=self.database._timeout)
+
     def _register_handlers(self, app):
         if app.config['TESTING']:
             return
-        app.before_request(self.connect_db)
-        app.teardown_request(self.close_db)
+        if app.config.get('DATABASE_POOL', True):
+            # Connections are per thread, so workers never share one with the server
+            app.before_request(self.connect_thread_db)
+        else:
+            app.before_request(self.connect_db)
+            app.teardown_request(self.close_db)
+
+    def connect_thread_db(self):
+        if self.database.connect(reuse_if_open=True):
+            self.set_query_only()
+
+    def connect_db(self):
+        super().connect_db()
+        self.set_query_only()
+
+    def set_query_only(self):
+        # Requests change the library through the writer thread, see write
+        if db_writer:
+            self.database.pragma('query_only', 1)
 
 # Defer init in app creation
 db_wrapper = AppDB()
@@ -67,6 +121,78 @@ def get_last_successful_log():
     return SyncLog.select().where(SyncLog.status == SYNC_OK).order_by(SyncLog.timestamp.desc()).get_or_none()
 
 
+class SyncStat(db_wrapper.Model):
+    """
+    Metrics of a sync stage, to tell apart network, database and scraping slowdowns
+    """
+    log = ForeignKeyField(SyncLog, backref='stats', on_delete="CASCADE")
+    stage = CharField()
+    request_count = IntegerField(default=0)
+    bytes_received = BigIntegerField(default=0)
+    http_time = FloatField(default=0)       # Seconds
+    rows_written = IntegerField(default=0)
+    write_time = FloatField(default=0)      # Seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows_written / self.write_time if self.write_time else 0
+
+    def __str__(self):
+        return f"[{self.stage}] {self.request_count} requests, {self.bytes_received} bytes in {self.http_time:.1f}s, {self.rows_written} rows in {self.write_time:.1f}s"
+
+
+def save_sync_stats(log, stats):
+    return SyncStat.insert_many([dict(log=log, stage=stage, **values) for stage, values in stats.items()]).execute() if stats else 0
+
+
+def get_sync_logs(limit):
+    logs = SyncLog.select().where(SyncLog.status != SYNC_STARTED).order_by(SyncLog.timestamp.desc()).limit(limit)
+    return prefetch(logs, SyncStat.select().order_by(SyncStat.id))
+
+
+class ImportCheckpoint(db_wrapper.Model):
+    """
+    Progress of a full import, so an interrupted one can be resumed
+    """
+    stage = CharField(primary_key=True)
+    started_on = TimestampField(utc=True)
+    saved_count = IntegerField(default=0)
+    # Key of the last saved row, to check if server ordering is the same 
+    last_key = CharField(default="")
+    completed = BooleanField(default=False)
+
+    def __str__(self):
+        return f"[{self.stage} {self.saved_count}{' completed' if self.completed else ''}] {self.last_key}"
+
+
+def get_import_checkpoints():
+    return {checkpoint.stage: checkpoint for checkpoint in ImportCheckpoint.select()}
+
+
+def get_import_started_on():
+    checkpoint = ImportCheckpoint.select().order_by(ImportCheckpoint.started_on).first()
+    return checkpoint.started_on if checkpoint else None
+
+
+def save_import_checkpoint(stage, saved_count=0, last_key="", completed=False):
+    update = {ImportCheckpoint.saved_count: ImportCheckpoint.saved_count + saved_count}
+    if last_key:
+        update[ImportCheckpoint.last_key] = last_key
+    if completed:
+        update[ImportCheckpoint.completed] = True
+    return (ImportCheckpoint.insert(stage=stage, saved_count=saved_count, last_key=last_key, completed=completed)
+            .on_conflict(conflict_target=[ImportCheckpoint.stage], update=update)
+            .execute())
+
+
+def reset_import_checkpoint(stage):
+    return ImportCheckpoint.delete().where(ImportCheckpoint.stage == stage).execute()
+
+
+def clear_import_checkpoints():
+    return ImportCheckpoint.delete().execute()
+
+
 class Series(db_wrapper.Model):
     tmdb_id = IntegerField(unique=True)
     imdb_id = CharField(default="")
@@ -83,8 +209,12 @@ class Series(db_wrapper.Model):
     vote_count = IntegerField(default=0)
     popularity = FloatField(default=0)
     status = FixedCharField(max_length=1)
-    language = FixedCharField(max_length=2)
+    language = FixedCharField(max_length=2, index=True)
     followed_since = DateField(null=True)
+    # Hash of the last saved server data, see filter_unchanged
+    fingerprint = BigIntegerField(null=True)
+    # Last season with episodes, see update_max_seasons
+    max_season = IntegerField(default=0)
 
 
     @property
@@ -107,9 +237,14 @@ class Series(db_wrapper.Model):
         return self.name
 
 
+# Few series are followed, index just those
+Series.add_index(Series.index(Series.followed_since, where=Series.followed_since.is_null(False)))
+
+
 class SeriesIndex(FTS5Model):
     """
-    Full-text search index for series
+    Full-text search index for series. Indexed text is read from the
+      series_search view and kept current by triggers on series table
     """
     rowid = RowIDField()
     name = SearchField()
@@ -117,11 +252,38 @@ class SeriesIndex(FTS5Model):
 
     class Meta:
         database = db_wrapper.database
-        options = {'tokenize': 'porter'}
+        options = {'tokenize': 'porter', 'content': 'series_search', 'content_rowid': 'id'}
+
+
+def get_series_index_values(row):
+    # Show original name too, if any
+    name = f"CASE WHEN {row}.original_name != '' AND {row}.original_name != {row}.name THEN {row}.name || ' / ' || {row}.original_name ELSE {row}.name END"
+    content = f"{row}.network || ' ' || {row}.overview"
+    return name, content
+
+SERIES_SEARCH_VIEW = """
+CREATE VIEW IF NOT EXISTS series_search AS 
+    SELECT series.id, {0} AS name, {1} AS content FROM series""".format(*get_series_index_values("series"))
+
+SERIES_INDEX_TRIGGERS = {
+    'series_index_insert': """
+CREATE TRIGGER IF NOT EXISTS series_index_insert AFTER INSERT ON series BEGIN
+    INSERT INTO seriesindex (rowid, name, content) VALUES (new.id, {0}, {1});
+END""".format(*get_series_index_values("new")),
+    'series_index_delete': """
+CREATE TRIGGER IF NOT EXISTS series_index_delete AFTER DELETE ON series BEGIN
+    INSERT INTO seriesindex (seriesindex, rowid, name, content) VALUES ('delete', old.id, {0}, {1});
+END""".format(*get_series_index_values("old")),
+    'series_index_update': """
+CREATE TRIGGER IF NOT EXISTS series_index_update AFTER UPDATE OF name, original_name, network, overview ON series BEGIN
+    INSERT INTO seriesindex (seriesindex, rowid, name, content) VALUES ('delete', old.id, {0}, {1});
+    INSERT INTO seriesindex (rowid, name, content) VALUES (new.id, {2}, {3});
+END""".format(*get_series_index_values("old"), *get_series_index_values("new")),
+}
 
 
 class Tag(db_wrapper.Model):
-    slug = CharField()
+    slug = CharField(index=True)
     name = CharField()
     type = FixedCharField(max_length=1)    
 
@@ -147,6 +309,8 @@ class Episode(db_wrapper.Model):
     aired_on = DateField(null=True)
     overview = TextField(default="")
     thumbnail_url = CharField(default="")
+    # Hash of the last saved server data, see filter_unchanged
+    fingerprint = BigIntegerField(null=True)
 
     @property
     def season_episode_id(self):
@@ -165,17 +329,46 @@ class Episode(db_wrapper.Model):
         )
 
 
-# class EpisodeIndex(FTS5Model):
-#     """
-#     Full-text search index for episodes
-#     """
-#     rowid = RowIDField()
-#     name = SearchField()
-#     overview = SearchField()
+class EpisodeIndex(FTS5Model):
+    """
+    Full-text search index for episodes, kept current by triggers on episode table
+    """
+    rowid = RowIDField()
+    name = SearchField()
+    overview = SearchField()
 
-#     class Meta:
-#         database = db_wrapper.database
-#         options = {'tokenize': 'porter'}
+    class Meta:
+        database = db_wrapper.database
+        options = {'tokenize': 'porter', 'content': 'episode', 'content_rowid': 'id'}
+
+
+EPISODE_INDEX_TRIGGERS = {
+    'episode_index_insert': """
+CREATE TRIGGER IF NOT EXISTS episode_index_insert AFTER INSERT ON episode BEGIN
+    INSERT INTO episodeindex (rowid, name, overview) VALUES (new.id, new.name, new.overview);
+END""",
+    'episode_index_delete': """
+CREATE TRIGGER IF NOT EXISTS episode_index_delete AFTER DELETE ON episode BEGIN
+    INSERT INTO episodeindex (episodeindex, rowid, name, overview) VALUES ('delete', old.id, old.name, old.overview);
+END""",
+    'episode_index_update': """
+CREATE TRIGGER IF NOT EXISTS episode_index_update AFTER UPDATE OF name, overview ON episode BEGIN
+    INSERT INTO episodeindex (episodeindex, rowid, name, overview) VALUES ('delete', old.id, old.name, old.overview);
+    INSERT INTO episodeindex (rowid, name, overview) VALUES (new.id, new.name, new.overview);
+END""",
+}
+
+def create_search_index_triggers():
+    for sql in [*SERIES_INDEX_TRIGGERS.values(), *EPISODE_INDEX_TRIGGERS.values()]:
+        db_wrapper.database.execute_sql(sql)
+
+def drop_search_index_triggers():
+    for name in [*SERIES_INDEX_TRIGGERS, *EPISODE_INDEX_TRIGGERS]:
+        db_wrapper.database.execute_sql(f'DROP TRIGGER IF EXISTS "{name}"')
+
+def rebuild_search_indexes():
+    SeriesIndex.rebuild()
+    EpisodeIndex.rebuild()
 
 class Release(db_wrapper.Model):
     # Enough for BitTorrent 2 SHA-256 hashes
@@ -183,7 +376,7 @@ class Release(db_wrapper.Model):
     # We could change an episode id, so update this FK accordingly
     episode = ForeignKeyField(
         Episode, backref='releases', on_update="CASCADE", on_delete="CASCADE")
-    added_on = DateTimeField()
+    added_on = DateTimeField(index=True)
     last_updated_on = DateTimeField()
     size = BigIntegerField()
     magnet_uri = TextField()
@@ -192,6 +385,8 @@ class Release(db_wrapper.Model):
     completed = IntegerField()
     name = CharField()
     resolution = SmallIntegerField()
+    # Hash of the last saved server data, see filter_unchanged
+    fingerprint = BigIntegerField(null=True)
 
     def __str__(self):
         return self.name
@@ -207,138 +402,270 @@ class Release(db_wrapper.Model):
         return iso639.extract_languages(self.name)
 
 
+class BestRelease(db_wrapper.Model):
+    """
+    Best release of each episode for a resolution and a ranking, 
+      kept current by refresh_best_releases
+    """
+    # Primary key already indexes episode
+    episode = ForeignKeyField(Episode, index=False, on_update="CASCADE", on_delete="CASCADE")
+    # Zero matches releases with any resolution
+    resolution = SmallIntegerField()
+    ranking = FixedCharField(max_length=1)
+    release = ForeignKeyField(Release, on_delete="CASCADE")
+
+    class Meta:
+        primary_key = CompositeKey('episode', 'resolution', 'ranking')
+
+
 class Tracker(db_wrapper.Model):
     url = CharField(unique=True)    
     status = FixedCharField(max_length=1, default=TRACKER_NOT_CONTACTED)
     last_scraped_on = DateTimeField(null=True)
 
 
+def get_fingerprint(row):
+    """
+    Return a compact 64-bit hash of the given server data
+    """
+    data = json.dumps(row, sort_keys=True, separators=(',', ':'), default=str).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big", signed=True)
+
+def filter_unchanged(model, rows):
+    """
+    Add a fingerprint to each row and drop the ones saved 
+      earlier with the very same content
+    """
+    for row in rows:
+        row.pop('fingerprint', None)
+        row['fingerprint'] = get_fingerprint(row)
+    saved_fingerprints = {}
+    for batch in chunked(rows, SELECT_CHUNK_SIZE):
+        saved_fingerprints.update(model
+                                  .select(model.id, model.fingerprint)
+                                  .where(model.id.in_([row['id'] for row in batch]))
+                                  .tuples())
+    return [row for row in rows if saved_fingerprints.get(row['id']) != row['fingerprint']]
+
+class SaveResult(int):
+    """
+    Number of saved rows, telling apart inserted and updated ones
+    """
+
+    def __new__(cls, inserted=0, updated=0):
+        result = super().__new__(cls, inserted + updated)
+        result.inserted = inserted
+        result.updated = updated
+        return result
+
+    def __add__(self, other):
+        if isinstance(other, SaveResult):
+            return SaveResult(self.inserted + other.inserted, self.updated + other.updated)
+        return int(self) + other
+
+    __radd__ = __add__
+
+    def __str__(self):
+        return str(int(self))
+
+    def __repr__(self):
+        return f"SaveResult(inserted={self.inserted}, updated={self.updated})"
+
+
+def get_max_variables():
+    """
+    Return how many bound parameters a single statement can have
+    """
+    connection = db_wrapper.database.connection()
+    try:
+        # Python 3.11+
+        return connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    except AttributeError:
+        return DEFAULT_MAX_VARIABLES
+
+def upsert(model, rows, conflict_target=None, preserve=None, callback=None):
+    """
+    Insert rows using as few statements as the SQLite variables limit allows,
+      in a single transaction. Rows already saved have their preserve fields 
+      updated, or are left untouched if preserve is empty. Return a SaveResult
+    """
+    if not rows:
+        return SaveResult()
+    conflict_target = conflict_target or [model._meta.primary_key]
+    fields = get_insert_fields(model, rows[0])
+    converters = [get_db_converter(field) for field in fields]
+    defaults = [get_default(field) for field in fields]
+    batch_size = max(1, get_max_variables() // len(fields))
+    sql = get_upsert_sql(model, fields, conflict_target, preserve)
+    row_sql = f"({', '.join('?' * len(fields))})"
+    count = len(rows)
+    with db_wrapper.database.atomic():
+        existing_keys = get_existing_keys(model, conflict_target, rows)
+        inserted = sum(1 for row in rows if get_row_key(row, conflict_target) not in existing_keys)
+        for index, batch in enumerate(chunked(rows, batch_size)):
+            if callback:
+                callback(int((index * batch_size) / count * 100))
+            params = []
+            for row in batch:
+                for field, converter, default in zip(fields, converters, defaults):
+                    value = row.get(field.name, row.get(field.column_name, default))
+                    params.append(None if value is None else converter(value))
+            db_wrapper.database.execute_sql(sql.format(values=', '.join([row_sql] * len(batch))), params)
+    # Ignored rows have been saved earlier with the same content
+    return SaveResult(inserted, count - inserted if preserve else 0)
+
+def get_insert_fields(model, row):
+    # Like Peewee insert, use row keys and any other field with a default
+    fields = [model._meta.combined[key] for key in row]
+    # Compare names, since field equality builds a query expression
+    names = {field.name for field in fields}
+    return fields + [field for field in model._meta.sorted_fields if field.name not in names and field.default is not None]
+
+def get_default(field):
+    return field.default() if callable(field.default) else field.default
+
+def get_db_converter(field):
+    if isinstance(field, (DateTimeField, DateField)):
+        # Server already sends dates in the format saved by Peewee, skip costly parsing
+        return lambda value: value if isinstance(value, str) else field.db_value(value)
+    return field.db_value
+
+def get_upsert_sql(model, fields, conflict_target, preserve):
+    columns = ', '.join(f'"{field.column_name}"' for field in fields)
+    target = ', '.join(f'"{field.column_name}"' for field in conflict_target)
+    if preserve:
+        updates = ', '.join(f'"{field.column_name}" = excluded."{field.column_name}"' for field in preserve)
+        conflict_clause = f"ON CONFLICT ({target}) DO UPDATE SET {updates}"
+    else:
+        conflict_clause = f"ON CONFLICT ({target}) DO NOTHING"
+    # Escape braces, values are filled in later for each batch
+    return f'INSERT INTO "{model._meta.table_name}" ({columns}) VALUES {{values}} {conflict_clause}'
+
+def get_row_key(row, conflict_target):
+    return tuple(row.get(field.name, row.get(field.column_name)) for field in conflict_target)
+
+def get_existing_keys(model, conflict_target, rows):
+    """
+    Return conflict target values of rows already saved
+    """
+    keys = list({get_row_key(row, conflict_target) for row in rows})
+    columns = ', '.join(f'"{field.column_name}"' for field in conflict_target)
+    row_sql = f"({', '.join('?' * len(conflict_target))})"
+    existing_keys = set()
+    for batch in chunked(keys, max(1, get_max_variables() // len(conflict_target))):
+        cursor = db_wrapper.database.execute_sql(
+            f'SELECT {columns} FROM "{model._meta.table_name}" WHERE ({columns}) IN (VALUES {", ".join([row_sql] * len(batch))})',
+            [value for key in batch for value in key])
+        existing_keys.update(cursor.fetchall())
+    return existing_keys
+
 def save_trackers(app, trackers):
     """
     Insert new trackers and ignore existing ones
     """    
-    count = 0
     app.logger.debug("Saving trackers to database...")
-    for batch in chunked(trackers, INSERT_CHUNK_SIZE):
-        # Skip rows causing the conflict, see:
-        #   https://sqlite.org/lang_conflict.html
-        count += (Tracker.insert_many(batch)
-                  .on_conflict_ignore()
-                  .as_rowcount()
-                  .execute())                
-    return count
+    return upsert(Tracker, trackers, conflict_target=[Tracker.url])
 
 def save_tags(app, tags):
     """
     Insert new tags and attempt to update existing ones
     """
-    count = 0
     app.logger.debug("Saving tags to database...")
-    for batch in chunked(tags, INSERT_CHUNK_SIZE):
-        count += (Tag.insert_many(batch)
-                  # Replace current tag with new data
-                  .on_conflict_replace()
-                  .as_rowcount()
-                  .execute())
-    return count
+    # Replace current tag with new data
+    return upsert(Tag, tags, preserve=[Tag.slug, Tag.name, Tag.type])
 
 def save_series(app, series, callback=None):
     """
     Insert new series and attempt to update existing ones
     """
-    count = 0
-    app.logger.debug("Saving series to database...")
-    series_count = len(series)
-    for index, batch in enumerate(chunked(series, INSERT_CHUNK_SIZE)):
-        if callback:
-            callback(int((index * INSERT_CHUNK_SIZE) / series_count * 100))        
-        count += (Series.insert_many(batch)
-                  .on_conflict(
-            conflict_target=[Series.id],
-            # Pass down values from insert clause
-            preserve=[Series.imdb_id, Series.name, Series.sort_name, Series.original_name, Series.language, Series.tagline, Series.overview, Series.network,
-                      Series.vote_average, Series.vote_count, Series.popularity, Series.poster_url, Series.fanart_url, Series.status])
-                  .as_rowcount()
-                  .execute())
-        for series in batch:
-            content = ' '.join([series['network'], series['overview']]) 
-            name = series['name']
-            if series['original_name'] and series['original_name'] != name:
-                name += ' / ' + series['original_name']            
-            # FTS5 insert_many cannot handle upserts
-            (SeriesIndex.insert({
-                SeriesIndex.rowid: series['id'],                    
-                SeriesIndex.name: name,
-                SeriesIndex.content: content,
-            })
-                # Just replace name and content edits
-                .on_conflict_replace()
-                .execute())
-    SeriesIndex.optimize()
-    return count
+    series = filter_unchanged(Series, series)
+    app.logger.debug(f"Saving {len(series)} changed series to database...")
+    # Search index is updated by triggers
+    return upsert(Series, series, 
+                  # Pass down values from insert clause
+                  preserve=[Series.imdb_id, Series.name, Series.sort_name, Series.original_name, Series.language, Series.tagline, Series.overview, Series.network,
+                            Series.vote_average, Series.vote_count, Series.popularity, Series.poster_url, Series.fanart_url, Series.status, Series.fingerprint],
+                  callback=callback)
 
 def save_series_tags(app, series_tags):
-    count = 0
     app.logger.debug("Saving series tags to database...")
-    for batch in chunked(series_tags, INSERT_CHUNK_SIZE):
-        count += (SeriesTag.insert_many(batch)
-                  # Skip rows causing the conflict, see:
-                  #   https://sqlite.org/lang_conflict.html
-                  .on_conflict_ignore()
-                  .execute())
-
-    return count
+    # Skip rows already there
+    return upsert(SeriesTag, series_tags, conflict_target=[SeriesTag.series, SeriesTag.tag])
 
 def save_episodes(app, episodes, callback=None):
     """
     Insert new episodes and attempt to update existing ones
     """
+    episodes = filter_unchanged(Episode, episodes)
+    app.logger.debug(f"Saving {len(episodes)} changed episodes to database...")
+    # We need to cope with the unique constraint for (series, season, number)
+    #   index because we cannot rely on episodes id's,
+    #   they are often changed when TVDB users update them
+    count = upsert(Episode, episodes, 
+                   conflict_target=[Episode.series, Episode.season, Episode.number],
+                   # Pass down values from insert clause
+                   preserve=[Episode.name, Episode.overview, Episode.type,
+                             Episode.aired_on, Episode.thumbnail_url, Episode.fingerprint],
+                   callback=callback)
+    # Search index is updated by triggers
+    update_max_seasons({episode.get('series', episode.get('series_id')) for episode in episodes})
+    return count
+
+def update_max_seasons(series_ids=None):
+    """
+    Refresh the last season number of the given series, or of all series
+    """
+    max_season = (Episode.select(fn.Coalesce(fn.Max(Episode.season), 0))
+                  .where(Episode.series == Series.id))
+    if series_ids is None:
+        return Series.update(max_season=max_season).execute()
     count = 0
-    app.logger.debug("Saving episodes to database...")
-    episode_count = len(episodes)
-    for index, batch in enumerate(chunked(episodes, INSERT_CHUNK_SIZE)):
-        # We need to cope with the unique constraint for (series, season, number)
-        #   index because we cannot rely on episodes id's,
-        #   they are often changed when TVDB users update them
-        if callback:
-            callback(int((index * INSERT_CHUNK_SIZE) / episode_count * 100))        
-        count += (Episode
-                  .insert_many(batch)
-                  .on_conflict(
-                      conflict_target=[
-                          Episode.series, Episode.season, Episode.number],
-                      # Pass down values from insert clause
-                      preserve=[Episode.name, Episode.overview, Episode.type,
-                                Episode.aired_on, Episode.thumbnail_url])
-                  .as_rowcount()
-                  .execute())
-        # EpisodeIndex.insert({
-        #     EpisodeIndex.rowid: episode_id,
-        #     EpisodeIndex.name: episode.name,
-        #     EpisodeIndex.overview: episode.overview}).execute()
-    #EpisodeIndex.optimize()            
+    for batch in chunked(list(series_ids), SELECT_CHUNK_SIZE):
+        count += Series.update(max_season=max_season).where(Series.id << batch).execute()
     return count
 
 def save_releases(app, releases, callback=None):
     """
     Insert new releases and attempt to update existing ones
     """
-    count = 0
-    app.logger.debug("Saving releases to database...")
-    release_count = len(releases)
-    for index, batch in enumerate(chunked(releases, INSERT_CHUNK_SIZE)):
-        if callback:
-            callback(int((index * INSERT_CHUNK_SIZE) / release_count * 100))
-        count += (Release
-                  .insert_many(batch)
-                  .on_conflict(
-                      conflict_target=[Release.id],
-                      # Pass down values from insert clause
-                      preserve=[Release.leechers, Release.seeders, Release.completed, Release.last_updated_on])
-                  .as_rowcount()
-                  .execute())
+    releases = filter_unchanged(Release, releases)
+    app.logger.debug(f"Saving {len(releases)} changed releases to database...")
+    count = upsert(Release, releases,
+                   # Pass down values from insert clause
+                   preserve=[Release.leechers, Release.seeders, Release.completed, Release.last_updated_on, Release.fingerprint],
+                   callback=callback)
+    refresh_best_releases({release.get('episode', release.get('episode_id')) for release in releases})
     return count
 
+def refresh_best_releases(episode_ids=None):
+    """
+    Pick again the best releases of the given episodes, or of all episodes
+    """
+    if episode_ids is None:
+        with db_wrapper.database.atomic():
+            BestRelease.delete().execute()
+            db_wrapper.database.execute_sql(get_best_release_sql("1"))
+        return
+    with db_wrapper.database.atomic():
+        for batch in chunked(list(episode_ids), SELECT_CHUNK_SIZE):
+            BestRelease.delete().where(BestRelease.episode << batch).execute()
+            # Pass ids once and refer to them in each select
+            values = ", ".join(["(?)"] * len(batch))
+            db_wrapper.database.execute_sql(
+                f"WITH changed(episode_id) AS (VALUES {values}) " + get_best_release_sql("episode_id IN changed"), batch)
+
+def get_best_release_sql(condition):
+    selects = []
+    for ranking, aggregate in RANKING_AGGREGATES.items():
+        # SQLite takes bare columns from the row matching the min or max aggregate,
+        #   resolution zero stands for any resolution
+        selects.append(f"""SELECT episode_id, resolution, '{ranking}', id FROM (
+            SELECT episode_id, resolution, id, {aggregate} FROM "release" 
+                WHERE resolution > 0 AND {condition} GROUP BY episode_id, resolution)""")
+        selects.append(f"""SELECT episode_id, 0, '{ranking}', id FROM (
+            SELECT episode_id, id, {aggregate} FROM "release" WHERE {condition} GROUP BY episode_id)""")
+    return f'INSERT INTO "{BestRelease._meta.table_name}" (episode_id, resolution, ranking, release_id) ' + " UNION ALL ".join(selects)
+
 class Torrent(db_wrapper.Model):
     release = ForeignKeyField(Release, unique=True, backref='torrent', on_delete="CASCADE")
     resume_data = BlobField(null=True)
@@ -347,6 +674,11 @@ class Torrent(db_wrapper.Model):
     file_storage = JSONField(default={})
     downloaded_on = DateTimeField(null=True)
 
+    class Meta:
+        indexes = (
+            (('status', 'downloaded_on'), False),
+        )
+
     def __str__(self):
         return f'{self.release.name} ({self.status})'
 
@@ -377,47 +709,246 @@ def remove_torrent(info_hash):
     release = _get_release(info_hash)
     return Torrent.delete().where(Torrent.release_id.in_(release)).execute() > 0
 
+########
+# WRITER
+########
+
+class DatabaseWriter(Thread):
+    """
+    Run every library change on a single thread, one command at 
+      a time, so threads never wait on each other for the database lock
+    """
+
+    def __init__(self, app):
+        super().__init__(name="Database writer")
+        self.app = app
+        self.queue = Queue()
+        self.lock = Lock()
+        self.stopped = False
+
+    def submit(self, handler, *args, **kwargs):
+        """
+        Queue a command and return a future with its result
+        """
+        future = Future()
+        with self.lock:
+            if self.stopped:
+                future.set_exception(RuntimeError(f"{self.name} has been stopped"))
+            else:
+                self.queue.put((future, handler, args, kwargs))
+        return future
+
+    def abort(self):
+        # Commands already queued are run first
+        self.queue.put(None)
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                command = self.queue.get()
+                if command is None:
+                    break
+                future, handler, args, kwargs = command
+                try:
+                    result = handler(*args, **kwargs)
+                except Exception as ex:
+                    future.set_exception(ex)
+                else:
+                    future.set_result(result)
+            db_wrapper.database.close()
+        # Fail commands sent while stopping
+        with self.lock:
+            self.stopped = True
+            while True:
+                try:
+                    command = self.queue.get_nowait()
+                except Empty:
+                    break
+                if command:
+                    command[0].set_exception(RuntimeError(f"{self.name} has been stopped"))
+
+
+db_writer = None
+
+def run_on_writer(handler, *args, **kwargs):
+    """
+    Run handler on the writer thread and return its result. Run it 
+      right away if there's no writer, like while testing
+    """
+    if db_writer and db_writer.is_alive() and current_thread() is not db_writer:
+        return db_writer.submit(handler, *args, **kwargs).result()
+    return handler(*args, **kwargs)
+
+def write(handler, *args, **kwargs):
+    """
+    Like run_on_writer, saving handler changes in a single transaction
+    """
+    def run():
+        with db_wrapper.database.atomic():
+            return handler(*args, **kwargs)
+    return run_on_writer(run)
+
+###########
+# BULK LOAD
+###########
+
+# Tables filled by a full library import
+BULK_LOAD_MODELS = [Tag, Series, SeriesTag, Episode, Release]
+# Kept for the best releases refresh done on each saved batch 
+BULK_LOAD_KEPT_INDEXES = ["release_episode_id"]
+
+def begin_bulk_load():
+    """
+    Trade durability and secondary indexes for write speed, 
+      return the previous synchronous setting
+    """
+    synchronous = db_wrapper.database.pragma('synchronous')
+    db_wrapper.database.pragma('synchronous', 0)
+    drop_secondary_indexes()
+    # Search indexes are rebuilt at the end in a single pass
+    drop_search_index_triggers()
+    return synchronous
+
+def end_bulk_load(synchronous):
+    create_secondary_indexes()
+    create_search_index_triggers()
+    rebuild_search_indexes()
+    # Give the query planner statistics about the new library
+    db_wrapper.database.execute_sql('ANALYZE')
+    db_wrapper.database.pragma('synchronous', synchronous)
+
+def drop_secondary_indexes():
+    """
+    Drop non-unique indexes of library tables, unique ones are needed by upserts
+    """
+    tables = [model._meta.table_name for model in BULK_LOAD_MODELS]
+    cursor = db_wrapper.database.execute_sql(f"""
+        SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL 
+            AND sql NOT LIKE 'CREATE UNIQUE%' AND tbl_name IN ({', '.join('?' * len(tables))})""", tables)
+    names = [name for name, in cursor.fetchall() if name not in BULK_LOAD_KEPT_INDEXES]
+    for name in names:
+        db_wrapper.database.execute_sql(f'DROP INDEX "{name}"')
+    return len(names)
+
+def create_secondary_indexes():
+    # Indexes left out by an interrupted bulk load are created when the import is resumed
+    for model in BULK_LOAD_MODELS:
+        model._schema.create_indexes(safe=True)
+
 ###########
 # DB SETUP
 ###########
 
+# Every model, in foreign keys order
+LIBRARY_MODELS = [
+    Series,
+    SeriesIndex,
+    Episode,
+    EpisodeIndex,
+    Release,
+    BestRelease,
+    Tracker,
+    Tag,
+    SeriesTag,
+    SyncLog,
+    SyncStat,
+    ImportCheckpoint,
+    Torrent,
+]
+
 def setup():
-    db_wrapper.database.create_tables([
-        Series,
-        SeriesIndex,
-        Episode,
-        Release,
-        Tracker,
-        Tag,
-        SeriesTag,
-        SyncLog,
-        Torrent,
-    ], safe=True)
-
-    # Run schema update for every fields added after version 0.5
-
-    #migrator = SqliteMigrator(db_wrapper.database)
-    introspector = Introspector.from_database(db_wrapper.database)
-    models = introspector.generate_models()
-    Series_ = models['series']
-    Episode_ = models['episode']
-
-    column_migrations = 0
-
-    # Add new columns
+    """
+    Create the library schema or bring it up to date, return the
+      number of migrations applied. A current schema costs a single 
+      user_version read
+    """
+    database = db_wrapper.database
+    version = database.pragma('user_version')
+    if version == SCHEMA_VERSION:
+        return 0
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Library schema version {version} is newer than supported version {SCHEMA_VERSION}, please update Videobox")
+    if not version and not Series.table_exists():
+        # New library, skip migrations and create the current schema
+        with database.atomic():
+            create_schema()
+            database.pragma('user_version', SCHEMA_VERSION)
+        return 0
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with database.atomic():
+            migration()
+            database.pragma('user_version', number)
+    return SCHEMA_VERSION - version
+
+def create_schema():
+    db_wrapper.database.create_tables(LIBRARY_MODELS)
+    # Create after any column they need 
+    db_wrapper.database.execute_sql(SERIES_SEARCH_VIEW)
+    create_search_index_triggers()
+    # Merge index segments a bit at a time on writes, instead of a costly optimize
+    SeriesIndex.automerge(SEARCH_INDEX_AUTOMERGE)
+    EpisodeIndex.automerge(SEARCH_INDEX_AUTOMERGE)
+
+# MIGRATIONS
+############
+
+def migrate_unversioned_schema():
+    """
+    Update a library created before schema versioning, 
+      which may miss any change made after version 0.5
+    """
+    database = db_wrapper.database
+    # Replace search index with the external content one, new in 0.9
+    series_index_sql = database.execute_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (SeriesIndex._meta.table_name,)).fetchone()
+    rebuild_series_index = not series_index_sql or 'content_rowid' not in series_index_sql[0]
+    if series_index_sql and rebuild_series_index:
+        SeriesIndex.drop_table()
+    # New in 0.9
+    rebuild_episode_index = not EpisodeIndex.table_exists()
+    refresh_best_release = not BestRelease.table_exists()
+
+    database.create_tables(LIBRARY_MODELS, safe=True)
+
+    columns = {table: {column.name for column in database.get_columns(table)} for table in ['series', 'episode', 'release']}
 
     # New in 0.8 
 
-    if not hasattr(Series_, 'original_name'):
-        db_wrapper.database.execute_sql('ALTER TABLE series ADD COLUMN original_name VARCHAR NOT NULL DEFAULT ""')
-        column_migrations += 1
+    if 'original_name' not in columns['series']:
+        database.execute_sql('ALTER TABLE series ADD COLUMN original_name VARCHAR NOT NULL DEFAULT ""')
+
+    if 'vote_count' not in columns['series']:
+        database.execute_sql('ALTER TABLE series ADD COLUMN vote_count INTEGER NOT NULL DEFAULT 0')
+
+    if 'type' not in columns['episode']:
+        database.execute_sql('ALTER TABLE episode ADD COLUMN type CHAR(1) DEFAULT "S"')
+
+    # New in 0.9
+
+    for table in ['series', 'episode', 'release']:
+        if 'fingerprint' not in columns[table]:
+            database.execute_sql(f'ALTER TABLE {table} ADD COLUMN fingerprint BIGINT')
+
+    if 'max_season' not in columns['series']:
+        database.execute_sql('ALTER TABLE series ADD COLUMN max_season INTEGER NOT NULL DEFAULT 0')
+        update_max_seasons()
 
-    if not hasattr(Series_, 'vote_count'):
-        db_wrapper.database.execute_sql('ALTER TABLE series ADD COLUMN vote_count INTEGER NOT NULL DEFAULT 0')
-        column_migrations += 1
+    database.execute_sql(SERIES_SEARCH_VIEW)
+    create_search_index_triggers()
+    if rebuild_series_index:
+        SeriesIndex.rebuild()
+        SeriesIndex.automerge(SEARCH_INDEX_AUTOMERGE)
+    if rebuild_episode_index:
+        EpisodeIndex.rebuild()
+        EpisodeIndex.automerge(SEARCH_INDEX_AUTOMERGE)
+    if refresh_best_release:
+        refresh_best_releases()
+    # Give the query planner statistics, a full import refreshes them
+    database.execute_sql('ANALYZE')
 
-    if not hasattr(Episode_, 'type'):
-        db_wrapper.database.execute_sql('ALTER TABLE episode ADD COLUMN type CHAR(1) DEFAULT "S"')
-        column_migrations += 1
+# Each step runs once in its own transaction, append new ones at the end
+MIGRATIONS = [
+    migrate_unversioned_schema,
+]
 
-    return column_migrations
\ No newline at end of file
+SCHEMA_VERSION = len(MIGRATIONS)
@@ -12,6 +12,7 @@ from urllib.parse import urlparse, parse_qs
 from peewee import *
 from flask import current_app as app
 import videobox.models as models
+import videobox.cache as cache
 from videobox.models import Series, Episode, Release, Tracker
 
 UDP_TIMEOUT = 3
@@ -136,22 +137,13 @@ def udp_parse_scrape_response(parsed_tracker, buf, sent_transaction_id, hashes):
 def udp_get_transaction_id():
     return random.randint(0, 255)
 
-def make_series_subquery():
-    SeriesAlias = Series.alias()
-    return (SeriesAlias.select(SeriesAlias, fn.Max(Episode.season).alias("max_season"))
-            .join(Episode)
-            .group_by(SeriesAlias.id))
-
 def get_releases(max_releases=None):
     since_datetime = datetime.now(timezone.utc) - timedelta(days=MAX_SCRAPING_INTERVAL)
-    series_subquery = make_series_subquery()
     return (Release.select(Release)
             .join(Episode)
             .join(Series)
-            .join(series_subquery, on=(
-                series_subquery.c.id == Series.id))
             # Do not bother to scrape releases from old seasons
-            .where((series_subquery.c.max_season-Episode.season < MAX_SEASONS) & 
+            .where((Series.max_season-Episode.season < MAX_SEASONS) & 
                    (Release.added_on >= since_datetime) & 
                    # Sqlite 'now' uses UTC, see https://www.sqlite.org/lang_datefunc.html
                    (fn.JulianDay('now') - fn.JulianDay(Release.last_updated_on) >
@@ -160,11 +152,11 @@ def get_releases(max_releases=None):
             .order_by(Release.added_on.desc())
             .limit(max_releases))
 
-def scrape_releases(max_releases=None): 
+def scrape_releases(max_releases=None, stats=None): 
     start = time.time()
     releases = get_releases(max_releases)
     trackers = collect_trackers(releases)
-    models.save_trackers(app, [{'url': tracker} for tracker in trackers])
+    models.write(models.save_trackers, app, [{'url': tracker} for tracker in trackers])
     # Contact less frequently those trackers which return fatal errors
     next_attempt_days = Case(Tracker.status, (
         (models.TRACKER_PROTOCOL_ERROR, NEXT_RETRY_DAYS),
@@ -182,7 +174,12 @@ def scrape_releases(max_releases=None):
         try:
             torrents = {}
             for chunked_info_hashes in chunked(info_hashes, MAX_TORRENTS):
-                torrents.update(scrape_tracker(tracker_url, chunked_info_hashes))
+                request_start = time.time()
+                try:
+                    torrents.update(scrape_tracker(tracker_url, chunked_info_hashes))
+                finally:
+                    if stats:
+                        stats.add_request(models.STAGE_SCRAPE, 0, time.time() - request_start)
                 # Do not flood server with requests
                 time.sleep(0.75)
             status = models.TRACKER_OK
@@ -204,12 +201,25 @@ def scrape_releases(max_releases=None):
             status = models.TRACKER_TIMED_OUT
             # Do not skip, but collect as much scraped data as possible
         finally:
-            Tracker.update(last_scraped_on=utc_now, status=status).where(Tracker.url == tracker_url).execute()
+            models.write(Tracker.update(last_scraped_on=utc_now, status=status).where(Tracker.url == tracker_url).execute)
 
         # Group scraped data by info_hash
         for info_hash, data in torrents.items():
             scraped_torrents.setdefault(info_hash, []).append(data)
 
+    write_start = time.time()
+    episode_ids = {release.episode_id for release in releases if release.info_hash in scraped_torrents}
+    models.write(save_scraped_torrents, scraped_torrents, episode_ids, utc_now)
+    # Pages ranking series by seeders are stale now
+    cache.page_cache.bump()
+    if stats:
+        stats.add_write(models.STAGE_SCRAPE, len(scraped_torrents), time.time() - write_start)
+    end = time.time()
+    app.logger.info(f"Scraped {len(scraped_torrents)} of {len(releases)} releases in {end-start:.1f}s.")
+    print(f"done, updated {len(scraped_torrents)} torrents.")
+
+
+def save_scraped_torrents(scraped_torrents, episode_ids, utc_now):
     for info_hash, all_data in scraped_torrents.items():
         # Get best seeds result for each torrent
         data = max(all_data, key=itemgetter("seeders"))
@@ -217,9 +227,8 @@ def scrape_releases(max_releases=None):
                        leechers=data['leechers'], 
                        completed=data['completed'],
                        last_updated_on=utc_now).where(Release.info_hash == info_hash).execute()
-    end = time.time()
-    app.logger.info(f"Scraped {len(scraped_torrents)} of {len(releases)} releases in {end-start:.1f}s.")
-    print(f"done, updated {len(scraped_torrents)} torrents.")
+    # Seeders changed, so best releases may have changed too
+    models.refresh_best_releases(episode_ids)
 
 
 def get_magnet_uri_trackers(magnet_uri):
@@ -0,0 +1,116 @@
+"""
+Offline library snapshots: a gzip-compressed SQLite database with 
+  the library tables, which can be loaded by another Videobox instance 
+  instead of doing a full import from the API server.
+"""
+
+import gzip
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+import videobox
+import videobox.models as models
+from videobox.models import db_wrapper, Tag, Series, SeriesTag, Episode, Release, SyncLog
+
+SNAPSHOT_VERSION = 1
+# Tables are copied in this order to satisfy foreign keys
+SNAPSHOT_MODELS = [Tag, Series, SeriesTag, Episode, Release]
+COPY_BUFFER_SIZE = 1024*1024   # Bytes
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def export_snapshot(path):
+    """
+    Write the library to the given path, returns the exported series count
+    """
+    last_log = models.get_last_successful_log()
+    if not last_log:
+        raise SnapshotError("Library is empty, there's nothing to export")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir).joinpath("snapshot.db")
+        database = db_wrapper.database
+        database.execute_sql("ATTACH DATABASE ? AS snapshot", (str(temp_path),))
+        try:
+            with database.atomic():
+                for model in SNAPSHOT_MODELS:
+                    table = model._meta.table_name
+                    database.execute_sql(f'CREATE TABLE snapshot."{table}" AS SELECT * FROM main."{table}"')
+                # Following series is a local user choice
+                database.execute_sql('UPDATE snapshot.series SET followed_since = NULL')
+                database.execute_sql('CREATE TABLE snapshot.snapshot_info (version INTEGER, app_version TEXT, created_on TEXT, synced_on TEXT)')
+                database.execute_sql('INSERT INTO snapshot.snapshot_info VALUES (?, ?, ?, ?)', (
+                    SNAPSHOT_VERSION, 
+                    videobox.__version__, 
+                    datetime.now(timezone.utc).isoformat(), 
+                    last_log.timestamp.replace(tzinfo=timezone.utc).isoformat()))
+        finally:
+            database.execute_sql("DETACH DATABASE snapshot")
+
+        with open(temp_path, "rb") as source, gzip.open(path, "wb") as target:
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+
+    return Series.select().count()
+
+
+def import_snapshot(path):
+    """
+    Load a snapshot written by export_snapshot into an empty library,
+      returns the imported series count
+    """
+    if models.get_last_successful_log() or Series.select().exists():
+        raise SnapshotError("Library is not empty, refusing to overwrite it")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir).joinpath("snapshot.db")
+        try:
+            with gzip.open(path, "rb") as source, open(temp_path, "wb") as target:
+                shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        except (OSError, EOFError) as ex:
+            raise SnapshotError(f"Could not read snapshot file ({ex})")
+
+        database = db_wrapper.database
+        try:
+            database.execute_sql("ATTACH DATABASE ? AS snapshot", (str(temp_path),))
+        except sqlite3.DatabaseError as ex:
+            raise SnapshotError(f"Invalid snapshot file ({ex})")
+        try:
+            version, synced_on = get_snapshot_info(database)
+            with database.atomic():
+                # Index all series at once, instead of a row at a time
+                models.drop_search_index_triggers()
+                for model in SNAPSHOT_MODELS:
+                    copy_table(database, model._meta.table_name, [field.column_name for field in model._meta.sorted_fields])
+                models.create_search_index_triggers()
+                models.rebuild_search_indexes()
+                # Older snapshots lack the column
+                models.update_max_seasons()
+                models.refresh_best_releases()
+                # Next sync will request updates since the snapshot was taken
+                SyncLog.create(timestamp=synced_on, status=models.SYNC_OK, description=f"imported library snapshot (version {version})")
+        finally:
+            database.execute_sql("DETACH DATABASE snapshot")
+
+    return Series.select().count()
+
+
+def get_snapshot_info(database):
+    try:
+        version, synced_on = database.execute_sql('SELECT version, synced_on FROM snapshot.snapshot_info').fetchone()
+    except (sqlite3.DatabaseError, TypeError):
+        raise SnapshotError("Invalid snapshot file, version information is missing")
+    if version > SNAPSHOT_VERSION:
+        raise SnapshotError(f"Snapshot version {version} is not supported, please update Videobox")
+    return version, datetime.fromisoformat(synced_on)
+
+
+def copy_table(database, table, columns):
+    # Older snapshots may miss columns added later, leave their defaults
+    snapshot_columns = {row[1] for row in database.execute_sql(f'PRAGMA snapshot.table_info("{table}")')}
+    column_list = ", ".join(f'"{column}"' for column in columns if column in snapshot_columns)
+    database.execute_sql(f'INSERT INTO main."{table}" ({column_list}) SELECT {column_list} FROM snapshot."{table}"')
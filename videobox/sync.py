@@ -1,19 +1,34 @@
 import time
+import random
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from threading import Thread, Event
-from peewee import chunked, fn
-from requests.exceptions import HTTPError, ReadTimeout
+from collections import deque
+from queue import Queue
+from threading import Thread, Event, Lock
+from peewee import fn
+from requests.exceptions import HTTPError, ReadTimeout, ConnectionError, RequestException
 from flask import current_app
 import requests
 import videobox.api as api
 import videobox.models as models
+import videobox.cache as cache
 import videobox.scraper as scraper
 from videobox.models import SyncLog
 
-REQUEST_CHUNK_SIZE = 450        # Total URI must be < 4096
-TIMEOUT_BEFORE_RETRY = 5        # Seconds
-SYNC_INTERVAL = 60*60*2         # Seconds
+MAX_CONCURRENT_REQUESTS = 4     # Chunks requested in parallel, be polite with the API
+IMPORT_BATCH_SIZE = 2000        # Rows kept in memory while importing 
+MAX_PENDING_BATCHES = 8         # Batches waiting to be saved into library
+MAX_REQUEST_ATTEMPTS = 5        # Including the first one
+MAX_RETRIES_PER_SYNC = 30       # Retries allowed in a single sync run
+RETRY_BACKOFF_BASE = 1          # Seconds
+RETRY_BACKOFF_MAX = 60          # Seconds
+MAX_RETRY_AFTER = 60*5          # Seconds, give up if server asks to wait longer
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+SYNC_INTERVAL = 60*60*2         # Seconds, used until the scheduler learns the update rate
 MIN_SYNC_INTERVAL = 60*15       # Seconds
+MAX_SYNC_INTERVAL = 60*60*8     # Seconds
+TARGET_SYNC_UPDATES = 100       # Updates we would like each sync to bring
 MAX_SCRAPED_RELEASES = 1000     # Avoid to scrape too much releases
 # https://stackoverflow.com/a/1508589
 ANSI_CLEAR_LINE = "\33[2K"
@@ -25,12 +40,233 @@ sync_worker = None
 class SyncError(Exception):
     pass
 
+
+class CheckpointMismatch(Exception):
+    pass
+
+
+IMPORT_STAGES = [
+    # Stage, API request, library save, label
+    (models.STAGE_TAGS, api.get_all_tags, models.save_tags, "tags"),
+    (models.STAGE_SERIES, api.get_all_series, models.save_series, "series"),
+    (models.STAGE_SERIES_TAGS, api.get_all_series_tags, models.save_series_tags, "series tags"),
+    (models.STAGE_EPISODES, api.get_all_episodes, models.save_episodes, "episodes"),
+    (models.STAGE_RELEASES, api.get_all_releases, models.save_releases, "torrents"),
+]
+
+def get_item_key(item):
+    # Series tags have no id of their own
+    return str(item['id']) if 'id' in item else f"{item['series_id']}/{item['tag_id']}"
+
+def format_count(count):
+    if isinstance(count, models.SaveResult) and count:
+        return f"{count} ({count.inserted} new)"
+    return str(count)
+
 def default_progress_callback(message):
     pass
 
 def default_done_callback(message, alert):
     pass
 
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter for failed requests, honouring 
+      server Retry-After header and capping the total retries per sync
+    """
+
+    def __init__(self, budget=MAX_RETRIES_PER_SYNC):
+        self.budget = budget
+        self.lock = Lock()
+
+    def consume(self):
+        # Requests run on several threads
+        with self.lock:
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            return True
+
+    def get_delay(self, attempt, response=None):
+        """
+        Return seconds to wait before the next attempt, or None
+          if server asked to wait for too long
+        """
+        # Full jitter, see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+        retry_after = get_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            if retry_after > MAX_RETRY_AFTER:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        retry_on = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_on - datetime.now(timezone.utc)).total_seconds())
+
+
+class SyncScheduler(object):
+    """
+    Adapt the time between syncs to how many updates 
+      recent syncs actually returned
+    """
+
+    def __init__(self, interval=SYNC_INTERVAL):
+        self.interval = interval
+
+    def on_sync(self, update_count, covered_time):
+        """
+        Update the interval given the updates found in the 
+          covered_time seconds since the previous successful sync
+        """
+        if update_count:
+            wanted_interval = covered_time * TARGET_SYNC_UPDATES / update_count
+        else:
+            # Quiet period, back off
+            wanted_interval = self.interval * 2
+        # Smooth out sudden changes
+        self.interval = (self.interval + wanted_interval) / 2
+        self.interval = int(max(MIN_SYNC_INTERVAL, min(self.interval, MAX_SYNC_INTERVAL)))
+        return self.interval
+
+
+class SyncStats(object):
+    """
+    Collect per-stage metrics of a sync run from several threads
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = Lock()
+
+    def add_request(self, stage, bytes_received, elapsed, count=1):
+        self._add(stage, request_count=count, bytes_received=bytes_received, http_time=elapsed)
+
+    def add_write(self, stage, rows_written, elapsed):
+        self._add(stage, rows_written=rows_written, write_time=elapsed)
+
+    def _add(self, stage, **values):
+        with self.lock:
+            stats = self.stages.setdefault(stage, dict(request_count=0, bytes_received=0, http_time=0, rows_written=0, write_time=0))
+            for key, value in values.items():
+                stats[key] += value
+
+
+class LibraryWriter(Thread):
+    """
+    Save batches to the library on a separate thread, so database
+      writes can overlap with network requests. Batches are saved 
+      by the database writer in the same order they are queued. 
+      In bulk mode batches are saved with relaxed durability,
+      and secondary indexes are rebuilt when the writer is closed
+    """
+
+    def __init__(self, app, stats=None, max_pending=MAX_PENDING_BATCHES, bulk=False):
+        super().__init__(name="Library writer")
+        self.app = app
+        self.stats = stats or SyncStats()
+        self.bulk = bulk
+        # Block producers when too many batches are waiting to be saved
+        self.queue = Queue(maxsize=max_pending)
+        self.counts = {}
+        self.error = None
+
+    def save(self, stage, save_handler, batch, checkpoint=False):
+        """
+        Queue a batch to be saved, if checkpoint is set the full import 
+          stage progress is updated in the same transaction
+        """
+        def save_batch():
+            count = save_handler(self.app, batch)
+            if checkpoint:
+                models.save_import_checkpoint(stage, len(batch), get_item_key(batch[-1]))
+            return count
+
+        def task():
+            start_time = time.time()
+            count = models.write(save_batch)
+            self.stats.add_write(stage, count, time.time() - start_time)
+            self.counts[save_handler] = self.get_count(save_handler) + count
+        self._put(task)
+
+    def complete_stage(self, stage):
+        self._put(lambda: models.write(models.save_import_checkpoint, stage, completed=True))
+
+    def reset_stage(self, stage):
+        self._put(lambda: models.write(models.reset_import_checkpoint, stage))
+
+    def get_count(self, save_handler):
+        return self.counts.get(save_handler, models.SaveResult())
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self._check_error()
+
+    def _put(self, task):
+        self._check_error()
+        self.queue.put(task)
+
+    def _check_error(self):
+        if self.error:
+            raise SyncError(f"Could not save data into library ({self.error}), giving up")
+
+    def run(self):
+        synchronous = None
+        with self.app.app_context():
+            try:
+                if self.bulk:
+                    synchronous = self._begin_bulk_load()
+                self._run_tasks()
+            finally:
+                if synchronous is not None:
+                    self._end_bulk_load(synchronous)
+                models.db_wrapper.database.close()
+
+    def _begin_bulk_load(self):
+        try:
+            # Safety level cannot be changed within a transaction
+            return models.run_on_writer(models.begin_bulk_load)
+        except Exception as ex:
+            self.app.logger.error(f"Error while preparing library for import: {ex}")
+            # Tasks are drained and producers get the error
+            self.error = ex
+            return None
+
+    def _end_bulk_load(self, synchronous):
+        start_time = time.time()
+        try:
+            models.run_on_writer(models.end_bulk_load, synchronous)
+        except Exception as ex:
+            self.app.logger.error(f"Error while rebuilding library indexes: {ex}")
+            self.error = self.error or ex
+        self.stats.add_write(models.STAGE_INDEXES, 0, time.time() - start_time)
+
+    def _run_tasks(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            # Keep draining the queue after an error, so producers do not block
+            if self.error:
+                continue
+            try:
+                task()
+            except Exception as ex:
+                self.app.logger.error(f"Error while saving into library: {ex}")
+                self.error = ex
+
+
 class SyncWorker(Thread):
 
     def __init__(self, client_id, progress_callback=default_progress_callback, done_callback=default_done_callback):
@@ -41,27 +277,43 @@ class SyncWorker(Thread):
         self.done_callback = done_callback
         # Start sync immediately at startup
         self.interval = 0
+        self.scheduler = SyncScheduler()
         self.abort_event = Event()        
+        # Set to start a sync before the interval has elapsed
+        self.wake_event = Event()
+        # Learn a good request size across syncs
+        self.chunk_sizer = api.ChunkSizer()
+        self.retry_policy = RetryPolicy()
+        self.stats = SyncStats()
 
     def abort(self):
         self.abort_event.set()
+        self.wake_event.set()
+
+    def wake(self):
+        self.wake_event.set()
 
     def run(self):
         # Set up a recurring execution unless asked to abort
         while not self.abort_event.is_set():
             if self.interval:
                 self.app.logger.debug(f"Waiting for {self.interval}s before next sync...")
-            self.abort_event.wait(self.interval)
+            self.wake_event.wait(self.interval)
             if self.abort_event.is_set():
                 self.app.logger.debug(f"Stopped {self.name} #{id(self)}")
                 return             
+            # Clear before syncing, so a wake up request meanwhile is not lost
+            self.wake_event.clear()
             self._run_sync()            
             # Schedule next sync
-            self.interval = SYNC_INTERVAL
+            self.interval = self.scheduler.interval
 
     def _run_sync(self):
         last_log = models.get_last_successful_log()
         start_time = time.time()
+        # Start each sync with the full retry budget
+        self.retry_policy = RetryPolicy()
+        self.stats = SyncStats()
 
         # Manually push the app context to make Flask
         #   logger to work on the separate thread
@@ -73,7 +325,7 @@ class SyncWorker(Thread):
                     self.app.logger.info(f"Sync request is below min. time interval of {MIN_SYNC_INTERVAL}s, ignored")
                     return
 
-            current_log = SyncLog.create(description="Started sync")
+            current_log = models.write(SyncLog.create, description="Started sync")
 
             alert = ""
             try:
@@ -81,133 +333,132 @@ class SyncWorker(Thread):
                     alert, tags_count, series_count, episode_count, release_count = self.update_library(
                         last_log)
                 else:
+                    # If resuming an import pick the time the first attempt started, 
+                    #   so next sync will request any update since then
+                    import_started_on = models.get_import_started_on()
                     tags_count, series_count, episode_count, release_count = self.import_library()
+                    if import_started_on:
+                        current_log.timestamp = import_started_on
             except SyncError as ex:
                 self.update_log(current_log, status=models.SYNC_ERROR, description=str(ex))
+                models.write(models.save_sync_stats, current_log, self.stats.stages)
+                # Batches saved before the error are in the library already
+                cache.page_cache.bump()
                 self.done_callback(str(ex), alert)
                 return
 
             elapsed_time = time.time()-start_time
             if any([series_count, episode_count, release_count]):
-                description = f"added/updated {tags_count} tags, {series_count} series, {episode_count} episodes, and {release_count} torrents"
+                description = (f"added/updated {tags_count} tags, {format_count(series_count)} series, "
+                               f"{format_count(episode_count)} episodes, and {format_count(release_count)} torrents")
             else:
                 description = "no updates were found"
 
             # Mark import/sync successful
             self.update_log(current_log, status=models.SYNC_OK, description=description)
+            models.write(models.clear_import_checkpoints)
+            # Endpoint copies are only needed to resume an import
+            api.clear_response_cache(self.app.config['API_CACHE_DIR'])
+            cache.page_cache.bump()
+            if last_log:
+                covered_time = (current_log.timestamp - last_log.timestamp).total_seconds()
+                self.scheduler.on_sync(series_count + episode_count + release_count, covered_time)
+                self.app.logger.debug(f"Next sync in {self.scheduler.interval}s")
             self.app.logger.info(f"Finished in {elapsed_time:.1f}s: {description}")
             self.done_callback(description, alert, last_log)
 
-            scraper.scrape_releases(MAX_SCRAPED_RELEASES)
+            scraper.scrape_releases(MAX_SCRAPED_RELEASES, self.stats)
+            models.write(models.save_sync_stats, current_log, self.stats.stages)
             print("Update completed, press CTRL+C to quit.")
 
     def import_library(self):
-        tags_count, series_count, episode_count, release_count = 0, 0, 0, 0
-        self.app.logger.info("No local database found, starting full import")
-        print("No local library found, starting full import (this may take a while):")
-
-        print("Downloading tags...", end="\r")
-
-        with requests.Session() as session:   
-        
-            json = self.do_json_request(
-                lambda: api.get_all_tags(session, self.client_id), retries=3)
-            if json:
-                print("Saving tags to library...", end="\r")
-                tags_count = models.save_tags(self.app, json)
-            
-            print(f"{ANSI_CLEAR_LINE}  • Imported {tags_count} tags.")
-
-            print("Downloading series...", end="\r")
-
-            json = self.do_json_request(
-                lambda: api.get_all_series(session, self.client_id))
-            if json:
-                series_count = models.save_series(self.app, json, 
-                                                callback=lambda percent: print(f"Saving series to library {percent}%", end="\r"))
-            
-            print(f"{ANSI_CLEAR_LINE}  • Imported {series_count} series.")
-
-            print("Downloading series tags...", end="\r")
-
-            json = self.do_json_request(
-                lambda: api.get_all_series_tags(session, self.client_id))
-            if json:
-                series_tags_count = models.save_series_tags(self.app, json)
-
-            print(f"{ANSI_CLEAR_LINE}  • Imported {series_tags_count} series tags.")
-
-            print("Downloading episodes...", end="\r")
-
-            json = self.do_json_request(
-                lambda: api.get_all_episodes(session, self.client_id))
-            if json:
-                episode_count = models.save_episodes(self.app, json, 
-                                                    callback=lambda percent: print(f"Saving episodes to library {percent}%", end="\r"))
-
-            print(f"{ANSI_CLEAR_LINE}  • Imported {episode_count} episodes.")
-
-            print("Downloading torrents...", end="\r")
-
-            json = self.do_json_request(
-                lambda: api.get_all_releases(session, self.client_id))
-            if json:
-                release_count = models.save_releases(self.app, json, 
-                                                    callback=lambda percent: print(f"Saving torrents to library {percent}%", end="\r"))
-
-        print(f"{ANSI_CLEAR_LINE}  • Imported {release_count} torrents.")
-
-        return tags_count, series_count, episode_count, release_count
+        checkpoints = models.get_import_checkpoints()
+        if checkpoints:
+            self.app.logger.info("Found an incomplete import, resuming from last checkpoint")
+            print("Resuming previous library import:")
+        else:
+            self.app.logger.info("No local database found, starting full import")
+            print("No local library found, starting full import (this may take a while):")
+
+        writer = LibraryWriter(self.app, self.stats, bulk=True)
+        writer.start()
+        try:
+            with requests.Session() as session:   
+                for stage, handler, save_handler, label in IMPORT_STAGES:
+                    checkpoint = checkpoints.get(stage)
+                    if checkpoint and checkpoint.completed:
+                        print(f"  • Skipped {label}, already imported.")
+                        continue
+                    print(f"Downloading {label}...", end="\r")
+                    try:
+                        count = self.do_streaming_import(
+                            lambda: handler(session, self.client_id), writer, save_handler, stage, checkpoint, f"Saving {label} to library")
+                    except CheckpointMismatch as ex:
+                        self.app.logger.warning(f"{ex}, importing all {label} again")
+                        # Nothing was queued for this stage yet, so just start over
+                        writer.reset_stage(stage)
+                        count = self.do_streaming_import(
+                            lambda: handler(session, self.client_id), writer, save_handler, stage, None, f"Saving {label} to library")
+                    print(f"{ANSI_CLEAR_LINE}  • Imported {count} {label}.")
+        finally:
+            # Wait for pending batches to be saved
+            writer.close()
+
+        return writer.get_count(models.save_tags), writer.get_count(models.save_series), writer.get_count(models.save_episodes), writer.get_count(models.save_releases)
 
     def update_library(self, last_log):
-        tags_count, series_count, episode_count, release_count = 0, 0, 0, 0
-        
         self.app.logger.info("Last update done at {0} UTC, requesting updates since then".format(
             last_log.timestamp.isoformat()))
         print("Attempt to sync library... ", end="", flush=True)
         self.progress_callback("Getting updated series...")
-        
-        with requests.Session() as session:
-            # Ensure UTC timezone
-            json = self.do_json_request(lambda: api.get_updated_series(session, 
-                self.client_id, last_log.timestamp.replace(tzinfo=timezone.utc)), retries=3)
-
-            # Save alert from server, if any
-            alert = json["alert"]
-
-            tag_ids = json['tags']
-            if tag_ids:
-                self.app.logger.debug(
-                    "Got {0} tags, starting update".format(len(tag_ids)))
-                tags_count = self.sync_tags(session, tag_ids)        
-
-            # Grab series
-            series_ids = json['series']
-            if series_ids:
-                self.app.logger.debug(
-                    "Got {0} series, starting update".format(len(series_ids)))
-                series_count = self.sync_series(session, series_ids)
-
-            # Grab episodes
-            episode_ids = json['episodes']
-            if episode_ids:
-                self.app.logger.debug(
-                    "Got {0} episodes, starting update".format(len(episode_ids)))
-                episode_count = self.sync_episodes(session, episode_ids)
-
-            # Grab releases
-            release_ids = json['releases']
-            if release_ids:
-                self.app.logger.debug(
-                    "Got {0} releases, starting update".format(len(release_ids)))
-                release_count = self.sync_releases(session, release_ids)
 
+        # Chunks are saved by the writer while the next ones are still downloading
+        writer = LibraryWriter(self.app, self.stats)
+        writer.start()
+        try:
+            with requests.Session() as session:
+                # Ensure UTC timezone
+                json = self.do_json_request(lambda: api.get_updated_series(session, 
+                    self.client_id, last_log.timestamp.replace(tzinfo=timezone.utc)), stage=models.STAGE_UPDATES)
+
+                # Save alert from server, if any
+                alert = json["alert"]
+
+                tag_ids = json['tags']
+                if tag_ids:
+                    self.app.logger.debug(
+                        "Got {0} tags, starting update".format(len(tag_ids)))
+                    self.sync_tags(session, writer, tag_ids)        
+
+                # Grab series
+                series_ids = json['series']
+                if series_ids:
+                    self.app.logger.debug(
+                        "Got {0} series, starting update".format(len(series_ids)))
+                    self.sync_series(session, writer, series_ids)
+
+                # Grab episodes
+                episode_ids = json['episodes']
+                if episode_ids:
+                    self.app.logger.debug(
+                        "Got {0} episodes, starting update".format(len(episode_ids)))
+                    self.sync_episodes(session, writer, episode_ids)
+
+                # Grab releases
+                release_ids = json['releases']
+                if release_ids:
+                    self.app.logger.debug(
+                        "Got {0} releases, starting update".format(len(release_ids)))
+                    self.sync_releases(session, writer, release_ids)
+        finally:
+            # Wait for pending chunks to be saved
+            writer.close()
+
+        release_count = writer.get_count(models.save_releases)
         print(f"done, added {release_count} torrents." if release_count else "no updates were found.")
-        return alert, tags_count, series_count, episode_count, release_count
-
-    def sync_tags(self, session, remote_ids):
-        count = 0
+        return alert, writer.get_count(models.save_tags), writer.get_count(models.save_series), writer.get_count(models.save_episodes), release_count
 
+    def sync_tags(self, session, writer, remote_ids):
         # Always request all remote ids so we have a chance to update existing series
         if remote_ids:
             def callback(remaining):
@@ -215,110 +466,163 @@ class SyncWorker(Thread):
                     f"Updating {remaining} tags...")
 
             # Request all remote tags
-            response = self.do_chunked_request(
-                api.get_tags_with_ids, session, remote_ids, callback)
-            if response:
-                count = models.save_tags(self.app, response)
-
-        return count
-
-    def sync_series(self, session, remote_ids):
-
-        # @@TODO
-        # local_count = (Series.select(fn.Count(Series.id))
-        #                .where((Series.id << remote_ids))
-        #                .scalar())
-        # missing_count = len(remote_ids) - local_count
-        count, missing_count = 0, 0
+            for json in self.do_chunked_request(api.get_tags_with_ids, session, remote_ids, models.STAGE_TAGS, callback):
+                writer.save(models.STAGE_TAGS, models.save_tags, json)
 
+    def sync_series(self, session, writer, remote_ids):
         # Always request all remote ids so we have a chance to update existing series
         if remote_ids:
-            # self.app.logger.debug(
-            #     f"Found missing {missing_count} of {len(remote_ids)} series")
             # Request old and new series
-            response = self.do_chunked_request(
-                api.get_series_with_ids, session, remote_ids, callback=lambda remaining: self.progress_callback(f"Updating {remaining} series..."))
-            if response:
-                count = models.save_series(self.app, response)
-
-            #  Series tags
-            response = self.do_chunked_request(
-                api.get_series_tags_for_ids, session, remote_ids, callback=lambda remaining: self.progress_callback(f"Updating {remaining} series tags..."))
-            if response:
-                models.save_series_tags(self.app, response)
+            for json in self.do_chunked_request(
+                    api.get_series_with_ids, session, remote_ids, models.STAGE_SERIES, callback=lambda remaining: self.progress_callback(f"Updating {remaining} series...")):
+                writer.save(models.STAGE_SERIES, models.save_series, json)
 
-        return count
-
-    def sync_episodes(self, session, remote_ids):
-
-        # local_ids = [e.id for e in Episode.select(Episode.id)]
-        # new_ids = set(remote_ids) - set(local_ids)
-        count, missing_count = 0, 0
+            #  Series tags, saved after series since writer preserves the queue order
+            for json in self.do_chunked_request(
+                    api.get_series_tags_for_ids, session, remote_ids, models.STAGE_SERIES_TAGS, callback=lambda remaining: self.progress_callback(f"Updating {remaining} series tags...")):
+                writer.save(models.STAGE_SERIES_TAGS, models.save_series_tags, json)
 
+    def sync_episodes(self, session, writer, remote_ids):
         # Always request all remote ids so we have a chance to update existing episodes
         if remote_ids:
-            # self.app.logger.debug(
-            #     f"Found missing {missing_count} of {len(remote_ids)} episodes")
             # Request old and new episodes
-            response = self.do_chunked_request(
-                api.get_episodes_with_ids, session, remote_ids, callback=lambda remaining: self.progress_callback(f"Updating {remaining} episodes..."))
-            if response:
-                count = models.save_episodes(self.app, response)
-
-        return count
-
-    def sync_releases(self, session, remote_ids):
-
-        # local_ids = [r.id for r in Release.select(Release.id)]
-        # new_ids = set(remote_ids) - set(local_ids)
-        count, missing_count = 0, 0
+            for json in self.do_chunked_request(
+                    api.get_episodes_with_ids, session, remote_ids, models.STAGE_EPISODES, callback=lambda remaining: self.progress_callback(f"Updating {remaining} episodes...")):
+                writer.save(models.STAGE_EPISODES, models.save_episodes, json)
 
+    def sync_releases(self, session, writer, remote_ids):
         # Always request all remote ids so we have a chance to update existing releases
         if remote_ids:
-            # self.app.logger.debug(
-            #     f"Found missing {missing_count} of {len(remote_ids)} releases")
             # Request old and new releases
-            response = self.do_chunked_request(
-                api.get_releases_with_ids, session, remote_ids, 
-                callback=lambda remaining: self.progress_callback(f"Updating {remaining} torrents..."))
-            if response:
-                count = models.save_releases(self.app, response)
-
-        return count
+            for json in self.do_chunked_request(
+                    api.get_releases_with_ids, session, remote_ids, models.STAGE_RELEASES,
+                    callback=lambda remaining: self.progress_callback(f"Updating {remaining} torrents...")):
+                writer.save(models.STAGE_RELEASES, models.save_releases, json)
 
     def update_log(self, log, status, description):
         log.status = status
         log.description = description
-        log.save()
-
-    def do_chunked_request(self, handler, session, ids, callback=None):
-        result = []
+        models.write(log.save)
+
+    def do_chunked_request(self, handler, session, ids, stage, callback=None):
+        """
+        Request ids in chunks keeping up to SYNC_MAX_CONCURRENT_REQUESTS 
+          requests in flight, yield each chunk response in the original order.
+          Chunk sizes follow the URL length limit and server response times
+        """
         ids_count = len(ids)
-        for index, chunked_ids in enumerate(chunked(ids, REQUEST_CHUNK_SIZE)):
-            if callback:
-                callback(ids_count - index*REQUEST_CHUNK_SIZE)
-            self.app.logger.debug(
-                f"Requesting {index + 1} of {ids_count // REQUEST_CHUNK_SIZE + 1} chunks")
-            json = self.do_json_request(
-                lambda: handler(session, self.client_id, chunked_ids))
-            result.extend(json)
-        return result
-
-    def do_json_request(self, handler, retries=1):
-        for index in reversed(range(retries)):
+        max_workers = max(1, self.app.config.get('SYNC_MAX_CONCURRENT_REQUESTS', MAX_CONCURRENT_REQUESTS))
+        max_length = api.get_ids_max_length(self.client_id)
+
+        def request_chunk(index, offset, chunked_ids):
+            # Pool threads need their own app context for logging and config
+            with self.app.app_context():
+                if callback:
+                    callback(ids_count - offset)
+                self.app.logger.debug(
+                    f"Requesting chunk {index + 1} with {len(chunked_ids)} of {ids_count} ids")
+                start_time = time.time()
+                json = self.do_json_request(
+                    lambda: handler(session, self.client_id, chunked_ids), timeout_callback=self.chunk_sizer.on_timeout, stage=stage)
+                self.chunk_sizer.on_response(time.time() - start_time)
+                return json
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Sync request")
+        pending = deque()
+        try:
+            for index, (offset, chunked_ids) in enumerate(api.iter_id_chunks(ids, self.chunk_sizer, max_length)):
+                pending.append(executor.submit(request_chunk, index, offset, chunked_ids))
+                # Keep a bounded number of responses waiting to be consumed
+                if len(pending) > max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Do not bother to request remaining chunks on errors
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def do_streaming_import(self, handler, writer, save_handler, stage, checkpoint, message, retries=MAX_REQUEST_ATTEMPTS):
+        """
+        Parse a (possibly huge) JSON array response incrementally and 
+          pass it to the writer in fixed-size batches, skipping rows 
+          already saved by a previous import attempt
+        """
+        count = 0
+        saved_count = checkpoint.saved_count if checkpoint else 0
+        skip_count = saved_count
+        start_time, write_wait = time.time(), 0
+        response = self.do_request(handler, retries)
+        try:
+            for batch, percent in api.iter_json_batches(response, IMPORT_BATCH_SIZE):
+                if skip_count:
+                    skipped = min(skip_count, len(batch))
+                    skip_count -= skipped
+                    if not skip_count and get_item_key(batch[skipped - 1]) != checkpoint.last_key:
+                        raise CheckpointMismatch(f"Server returned {stage} in a different order than last time")
+                    batch = batch[skipped:]
+                    if not batch:
+                        continue
+                # Do not account time waiting for the writer as network time
+                wait_start_time = time.time()
+                writer.save(stage, save_handler, batch, checkpoint=True)
+                write_wait += time.time() - wait_start_time
+                count += len(batch)
+                if percent is not None:
+                    progress = f"{message} {percent}%"
+                else:
+                    # Streamed or compressed responses have no known size
+                    progress = f"{message} {saved_count + count:,} rows"
+                print(progress, end="\r")
+                self.progress_callback(progress)
+        except (RequestException, ValueError) as ex:
+            message = f'Error while reading server response ({ex}), giving up'
+            self.app.logger.error(message)
+            raise SyncError(message)
+        finally:
+            self.stats.add_request(stage, api.get_response_size(response), time.time() - start_time - write_wait)
+            response.close()
+        if skip_count:
+            raise CheckpointMismatch(f"Server returned fewer {stage} than last time")
+        writer.complete_stage(stage)
+        return count
+
+    def do_json_request(self, handler, retries=MAX_REQUEST_ATTEMPTS, timeout_callback=None, stage=None):
+        start_time = time.time()
+        response = self.do_request(handler, retries, timeout_callback)
+        json = response.json()
+        if stage:
+            self.stats.add_request(stage, api.get_response_size(response), time.time() - start_time)
+        return json
+
+    def do_request(self, handler, retries=MAX_REQUEST_ATTEMPTS, timeout_callback=None):
+        for attempt in range(retries):
+            response = None
             try:
                 response = handler()
                 response.raise_for_status()  # Raise an exeption on HTTP errors
-            except ReadTimeout as ex:
-                message = f'Server timed out while handling the request, {"retrying" if index else "skipped"}'
-                self.app.logger.warn(message)
-                time.sleep(TIMEOUT_BEFORE_RETRY)
-                continue  # Next retry
+                return response
+            except ReadTimeout:
+                message = 'Server timed out while handling the request'
+                if timeout_callback:
+                    timeout_callback()
+            except ConnectionError as ex:
+                message = f'Could not connect to server ({ex})'
             except HTTPError as ex:
-                message = f'Server error {ex.response.status_code} occurred while handling the request, giving up'
-                self.app.logger.error(message)
-                raise SyncError(message)
-            return response.json()
-        # No more retries, giving up
-        raise SyncError(
-            "Server timed out while handling the request")
\ No newline at end of file
+                message = f'Server error {ex.response.status_code} occurred while handling the request'
+                if ex.response.status_code not in RETRY_STATUS_CODES:
+                    self.app.logger.error(f"{message}, giving up")
+                    raise SyncError(f"{message}, giving up")
+            finally:
+                # Release the connection of a failed streamed request
+                if response is not None and not response.ok:
+                    response.close()
+
+            delay = self.retry_policy.get_delay(attempt, response)
+            if attempt == retries - 1 or delay is None or not self.retry_policy.consume():
+                self.app.logger.error(f"{message}, giving up")
+                raise SyncError(f"{message}, giving up")
+            self.app.logger.warning(f"{message}, retrying in {delay:.1f}s")
+            if self.abort_event.wait(delay):
+                raise SyncError("Sync was aborted")